@@ -0,0 +1,137 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Sends binaries to a running pykvm.server and prints the results.
+This module deliberately avoids importing the KVM code, so that it starts quickly.
+"""
+
+import os
+import socket
+import sys
+from argparse import ArgumentParser
+
+from hexdump import hexdump
+
+from pykvm.hypercall import HYPERCALL_RING_ADDR
+from pykvm.protocol import DEFAULT_SOCKET, send_message, recv_message
+
+
+class Client(object):
+    def __init__(self, path=DEFAULT_SOCKET):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+    def close(self):
+        self._sock.close()
+
+    def run(self, binary=None, data=b'', memsize=0x20000, rip=0, rsp=0xfff0, org=0, dump=(), ring=None,
+            timeout=None):
+        """
+        Runs a binary on the server. Pass either the path of the binary (which must be readable by the server)
+        or its contents. If the binary runs for longer than timeout seconds (or the default timeout of the server
+        if timeout is None), it is stopped and the result has timed_out set.
+
+        :return: A (result, dumps) tuple. result is the final message from the server, dumps is a list of
+        (addr, data) tuples for each requested range.
+        """
+        job = {
+            'type': 'job',
+            'binary': os.path.abspath(binary) if binary is not None else None,
+            'memsize': memsize,
+            'rip': rip,
+            'rsp': rsp,
+            'org': org,
+            'dump': [list(r) for r in dump],
+            'ring': ring,
+            'timeout': timeout,
+        }
+        send_message(self._sock, job, data if binary is None else b'')
+
+        dumps = []
+        while True:
+            message, payload = recv_message(self._sock)
+            if message is None:
+                raise RuntimeError('Server closed the connection')
+
+            if message['type'] == 'dump':
+                dumps.append((message['addr'], payload))
+            elif message['type'] == 'error':
+                raise RuntimeError('Job failed: %s' % message['message'])
+            else:
+                message['output'] = payload
+                return message, dumps
+
+
+def main():
+    parser = ArgumentParser(description='Runs binaries on a pykvm.server')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Path of the server socket')
+    parser.add_argument('--memsize', type=lambda x: int(x, 0), default=0x20000, help='Size of guest memory in bytes')
+    parser.add_argument('--rip', type=lambda x: int(x, 0), default=0x0, help='Initial program counter')
+    parser.add_argument('--rsp', type=lambda x: int(x, 0), default=0xfff0, help='Initial stack pointer')
+    parser.add_argument('--org', type=lambda x: int(x, 0), default=0x0, help='Load base of the binary')
+    parser.add_argument('--dump', type=lambda x: int(x, 0), default=0x1000, help='Address to dump when complete')
+    parser.add_argument('--dump-size', type=lambda x: int(x, 0), default=0x100, help='How many bytes to dump')
+    parser.add_argument('--ring', action='store_true', help='Enable the hypercall ring (see sample/pykvm.h)')
+    parser.add_argument('--ring-addr', type=lambda x: int(x, 0), default=HYPERCALL_RING_ADDR,
+                        help='Address of the hypercall ring')
+    parser.add_argument('--timeout', type=float, default=None, help='Stop binaries that run for longer than this')
+    parser.add_argument('--by-path', action='store_true',
+                        help='Send the path of the binaries instead of their contents')
+    parser.add_argument('binary', nargs='+', help='Raw binary files to execute (32-bit x86)')
+    args = parser.parse_args()
+
+    client = Client(args.socket)
+
+    try:
+        for binary in args.binary:
+            kwargs = {}
+            if args.by_path:
+                kwargs['binary'] = binary
+            else:
+                with open(binary, 'rb') as fp:
+                    kwargs['data'] = fp.read()
+
+            result, dumps = client.run(memsize=args.memsize, rip=args.rip, rsp=args.rsp, org=args.org,
+                                       dump=[(args.dump, args.dump_size)],
+                                       ring=args.ring_addr if args.ring else None, timeout=args.timeout, **kwargs)
+
+            regs = result['regs']
+            print('%s: %s%s' % (binary, result['exit_reason'], ' (timed out)' if result['timed_out'] else ''))
+            print('rax=%#x rbx=%#x rcx=%#x rdx=%#x' % (regs['rax'], regs['rbx'], regs['rcx'], regs['rdx']))
+            print('rsi=%#x rdi=%#x rbp=%#x rsp=%#x' % (regs['rsi'], regs['rdi'], regs['rbp'], regs['rsp']))
+            print('rip=%#x' % regs['rip'])
+
+            for addr, data in dumps:
+                print('Dumping address %#x of size %#x' % (addr, len(data)))
+                hexdump(data)
+
+            if result['output']:
+                print('Guest output (%d bytes)' % len(result['output']))
+                hexdump(result['output'])
+    except RuntimeError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
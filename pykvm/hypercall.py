@@ -0,0 +1,172 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Paravirtual channel between the guest and PyKVM.
+
+The guest queues requests in a ring located in guest RAM, then writes to the doorbell port.
+Reading from the doorbell port does not process the ring.
+The resulting I/O exit is handled by the HypercallRing, which processes all the queued requests,
+stores their results in the ring, and resumes the guest. This way, the guest pays for one exit per batch
+of requests rather than one per request.
+
+The layout of the ring must match sample/pykvm.h.
+"""
+
+import ctypes
+import logging
+from ctypes import Structure, c_uint32, c_uint64
+from enum import IntEnum
+
+from pykvm.kvm_types import KVMExitIODirection
+
+logger = logging.getLogger(__name__)
+
+HYPERCALL_RING_ADDR = 0x10000
+HYPERCALL_RING_ENTRIES = 64
+HYPERCALL_DOORBELL_PORT = 0x5000
+
+
+class HypercallFunction(IntEnum):
+    # Copies args[1] bytes at guest address args[0] to the host output buffer
+    HYPERCALL_WRITE = 1
+
+
+class HypercallStatus(IntEnum):
+    HYPERCALL_PENDING = 0
+    HYPERCALL_OK = 1
+    HYPERCALL_UNKNOWN_FUNCTION = 2
+    HYPERCALL_ERROR = 3
+
+
+class HypercallRingHeader(Structure):
+    _fields_ = [
+        # Free-running index of the next request, incremented by the guest
+        ('head', c_uint32),
+
+        # Free-running index of the next request to process, incremented by the host
+        ('tail', c_uint32),
+
+        # Number of entries in the ring, set by the host
+        ('entries', c_uint32),
+        ('padding', c_uint32),
+    ]
+
+
+class HypercallEntry(Structure):
+    _fields_ = [
+        ('function', c_uint32),
+        ('status', c_uint32),
+        ('args', c_uint64 * 4),
+        ('ret', c_uint64),
+    ]
+
+    def __str__(self):
+        return 'function = %d args = %s' % (self.function, ', '.join('%#x' % a for a in self.args))
+
+
+class HypercallRing(object):
+    """
+    Host side of the hypercall ring. Creating the ring initializes it in guest RAM and
+    registers the doorbell handler on the VM.
+    """
+
+    def __init__(self, vm, addr=HYPERCALL_RING_ADDR, entries=HYPERCALL_RING_ENTRIES, port=HYPERCALL_DOORBELL_PORT):
+        self._vm = vm
+        self._addr = addr
+        self._entries = entries
+        self._size = ctypes.sizeof(HypercallRingHeader) + entries * ctypes.sizeof(HypercallEntry)
+
+        if addr + self._size > vm.ram.size:
+            raise RuntimeError('Hypercall ring at %#x does not fit in guest RAM' % addr)
+
+        self._handlers = {}
+        self.output = bytearray()
+        self.register(HypercallFunction.HYPERCALL_WRITE, self._write)
+
+        self.reset()
+
+        vm.register_io_handler(port, self._on_doorbell)
+
+        # The output belongs to the execution path that produced it
+        vm.register_device(self._save_state, self._restore_state)
+
+    def reset(self):
+        """
+        Empties the ring and the output buffer, e.g., before running another binary in the same VM.
+        """
+        self.output = bytearray()
+
+        header = HypercallRingHeader()
+        header.entries = self._entries
+        self._vm.ram.write(self._addr, ctypes.string_at(ctypes.addressof(header), ctypes.sizeof(header)))
+
+    def register(self, function, handler):
+        """
+        Registers the handler for the given function number.
+        The handler gets the VM and the four arguments of the request. It returns the result for the guest.
+        """
+        self._handlers[function] = handler
+
+    def _save_state(self):
+        return bytes(self.output)
+
+    def _restore_state(self, data):
+        self.output = bytearray(data)
+
+    def _write(self, vm, addr, size, *_):
+        self.output += vm.ram.read(addr, size)
+        return size
+
+    def _on_doorbell(self, io):
+        if io.direction != KVMExitIODirection.KVM_EXIT_IO_OUT:
+            # The guest gets whatever is in the data area, don't let it believe that this flushed the ring
+            logger.warning('Ignoring read from the hypercall doorbell port (%s)', io)
+            return
+
+        # The guest is stopped, so we can read the whole ring at once and write it back when done
+        ring = bytearray(self._vm.ram.read(self._addr, self._size))
+        header = HypercallRingHeader.from_buffer(ring)
+        entries = (HypercallEntry * self._entries).from_buffer(ring, ctypes.sizeof(HypercallRingHeader))
+
+        count = (header.head - header.tail) & 0xffffffff
+        if count > self._entries:
+            logger.error('Corrupted hypercall ring: head=%d tail=%d', header.head, header.tail)
+            return
+
+        for i in range(count):
+            entry = entries[(header.tail + i) % self._entries]
+            handler = self._handlers.get(entry.function)
+            if handler is None:
+                logger.warning('Unknown hypercall %s', entry)
+                entry.status = HypercallStatus.HYPERCALL_UNKNOWN_FUNCTION
+                continue
+
+            try:
+                entry.ret = handler(self._vm, *entry.args)
+                entry.status = HypercallStatus.HYPERCALL_OK
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Hypercall %s failed', entry)
+                entry.status = HypercallStatus.HYPERCALL_ERROR
+
+        header.tail = header.head
+        self._vm.ram.write(self._addr, bytes(ring))
+
+        logger.debug('Processed %d hypercalls', count)
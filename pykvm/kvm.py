@@ -18,33 +18,69 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import array
 import errno
 import fcntl
 import logging
 import mmap
 import os
+import signal
+import struct
+import threading
 from argparse import ArgumentParser
 
 import ctypes
 from ctypes import c_int, c_size_t, c_void_p
 from ctypes.util import find_library as ctypes_find_library
 
+import numpy
 from hexdump import hexdump
 
 # We use most of the classes from there, importing one by one is too tedious
 # pylint: disable=unused-wildcard-import
 # pylint: disable=wildcard-import
 from pykvm.kvm_types import *
+from pykvm.hypercall import HypercallRing, HYPERCALL_RING_ADDR
 
 logger = logging.getLogger(__name__)
 
 libc = ctypes.cdll.LoadLibrary(ctypes_find_library('c'))
 libc.mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_size_t]
 libc.mmap.restype = c_void_p
+libc.madvise.argtypes = [c_void_p, c_size_t, c_int]
+libc.madvise.restype = c_int
+libc.munmap.argtypes = [c_void_p, c_size_t]
+libc.munmap.restype = c_int
 
 
 MAP_FAILED = 0xffffffffffffffff
+MADV_DONTNEED = 4
+
+PAGE_SIZE = 0x1000
+
+# Sent by VCPU.force_exit() to kick the thread running the VCPU out of the guest when KVM_CAP_FORCE_EXIT
+# is not available. See install_force_exit_handler().
+FORCE_EXIT_SIGNAL = signal.SIGUSR1
+SECTOR_SIZE = 512
+
+# Size of the window scanned at once by RAM.find(). This bounds the size of the temporary
+# arrays when the pattern is very common (e.g., looking for zeros in a mostly empty guest).
+_SEARCH_CHUNK_SIZE = 0x1000000
+
+# RAM.find() estimates byte frequencies from every n-th byte of each chunk. The stride is odd so that
+# the sample does not only hit the same offsets of aligned structures.
+_SEARCH_SAMPLE_STRIDE = 61
+
+# Bounce buffers for KVM_MEM_RW larger than this are not kept around
+_MAX_BOUNCE_BUFFER_SIZE = 0x100000
+
+# RAM.read_many() reads the gap between two ranges instead of issuing a separate
+# KVM_MEM_RW call if the gap is at most this many bytes.
+_MAX_COALESCE_GAP = 0x400
+
+# Odd multipliers for RAM.page_hashes(). Any fixed set of random odd constants works,
+# the seed only needs to be stable so that hashes can be compared across runs.
+_PAGE_HASH_MULTIPLIERS = numpy.random.RandomState(0x6b766d).randint(
+    0, 2 ** 63, size=PAGE_SIZE // 8, dtype=numpy.uint64) * numpy.uint64(2) + numpy.uint64(1)
 
 
 class RAM(object):
@@ -55,7 +91,6 @@ class RAM(object):
         self._size = size
         self._vm = vm
 
-        # TODO: deallocate memory on exit
         logger.debug('Allocating %d bytes for RAM', size)
         self._pointer = libc.mmap(-1, self._size, mmap.PROT_READ | mmap.PROT_WRITE,
                                   mmap.MAP_ANON | mmap.MAP_PRIVATE, -1, 0)
@@ -66,6 +101,14 @@ class RAM(object):
         logger.debug('RAM is at %#lx', self._pointer)
         self.obj = (ctypes.c_ubyte * size).from_address(self._pointer)
 
+        self._bounce_buffer = ctypes.create_string_buffer(PAGE_SIZE)
+        self._mem_rw_request = KVMMemRW()
+        self._cache_enabled = False
+        self._cache = {}
+
+        # Number of KVM_MEM_RW calls issued so far
+        self.mem_rw_count = 0
+
     def get_kvm_region(self, slot):
         ram = KVMUserSpaceMemoryRegion()
         ram.slot = slot
@@ -75,39 +118,364 @@ class RAM(object):
         ram.userspace_addr = self._pointer
         return ram
 
-    def write(self, addr, data):
-        if addr + len(data) > self._size:
-            raise RuntimeError('Buffer overflow')
+    def _get_bounce_buffer(self, size):
+        """
+        Returns a host buffer of at least size bytes for KVM_MEM_RW. The buffer is reused across calls,
+        except for very large transfers, which get their own temporary buffer.
+        """
+        if size > _MAX_BOUNCE_BUFFER_SIZE:
+            return ctypes.create_string_buffer(size)
 
-        if self._vm.has_mem_rw:
-            b = (ctypes.c_ubyte * len(data)).from_buffer_copy(data)
-            m = KVMMemRW()
-            m.source = ctypes.addressof(b)
+        if len(self._bounce_buffer) < size:
+            new_size = len(self._bounce_buffer)
+            while new_size < size:
+                new_size *= 2
+            self._bounce_buffer = ctypes.create_string_buffer(new_size)
+
+        return self._bounce_buffer
+
+    def _mem_rw(self, addr, host_addr, size, is_write):
+        """
+        Copies size bytes between guest address addr and the host buffer at host_addr.
+        """
+        m = self._mem_rw_request
+        if is_write:
+            m.source = host_addr
             m.dest = self._pointer + addr
-            m.is_write = 1
-            m.length = len(data)
-            logger.debug('Writing to %#lx from %#lx, size=%#lx', m.dest, m.source, m.length)
-            fcntl.ioctl(self._vm.fd, KVM_MEM_RW, m)
         else:
-            for i, c in enumerate(data):
-                self.obj[addr + i] = ord(c)
+            m.source = self._pointer + addr
+            m.dest = host_addr
+        m.is_write = is_write
+        m.length = size
+        fcntl.ioctl(self._vm.fd, KVM_MEM_RW, m)
+        self.mem_rw_count += 1
 
-    def read(self, addr, size):
-        if addr + size > self._size:
+    def _write_range(self, addr, data):
+        if self._vm.has_mem_rw:
+            b = self._get_bounce_buffer(len(data))
+            ctypes.memmove(b, data, len(data))
+            logger.debug('Writing to %#lx, size=%#lx', self._pointer + addr, len(data))
+            self._mem_rw(addr, ctypes.addressof(b), len(data), 1)
+            self._update_cache(addr, data)
+        else:
+            ctypes.memmove(self._pointer + addr, data, len(data))
+
+    def _read_range(self, addr, size):
+        if self._vm.has_mem_rw:
+            b = self._get_bounce_buffer(size)
+            self._mem_rw(addr, ctypes.addressof(b), size, 0)
+            return ctypes.string_at(b, size)
+
+        return ctypes.string_at(self._pointer + addr, size)
+
+    def clear(self):
+        """
+        Fills guest memory with zeros.
+        """
+        self._cache.clear()
+
+        if self._vm.has_mem_rw:
+            zeros = b'\0' * min(self._size, _MAX_BOUNCE_BUFFER_SIZE)
+            for addr in range(0, self._size, len(zeros)):
+                self._write_range(addr, zeros[:self._size - addr])
+            return
+
+        # Dropping the pages is faster than writing zeros to them, the kernel
+        # will map zero pages back on the next access.
+        if libc.madvise(self._pointer, self._size, MADV_DONTNEED):
+            raise RuntimeError('Could not clear RAM')
+
+    def close(self):
+        """
+        Releases guest memory. Arrays returned by as_array() must not be used afterwards.
+        """
+        if self._pointer is None:
+            return
+
+        self.obj = None
+        if libc.munmap(self._pointer, self._size):
+            logger.error('Could not unmap RAM at %#lx', self._pointer)
+        self._pointer = None
+
+    def _check_range(self, addr, size):
+        if addr < 0 or addr + size > self._size:
             raise RuntimeError('Buffer overflow')
 
+    def write(self, addr, data):
+        self._check_range(addr, len(data))
+        self._write_range(addr, bytes(data))
+
+    def read(self, addr, size):
+        self._check_range(addr, size)
+
+        if self._use_cache():
+            return self.read_many([(addr, size)])[0]
+
+        return self._read_range(addr, size)
+
+    def read_many(self, ranges):
+        """
+        Reads several ranges of guest memory at once. Ranges that are close to each other are coalesced,
+        so that the whole batch costs as few KVM_MEM_RW calls as possible.
+
+        :param ranges: A list of (address, size) tuples
+        :return: A list with the contents of each range, in the same order
+        """
+        for addr, size in ranges:
+            self._check_range(addr, size)
+
+        if self._use_cache():
+            return self._read_many_cached(ranges)
+
+        ret = [None] * len(ranges)
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+
+        # Each group is [start, end, indexes of the ranges it covers]
+        groups = []
+        for i in order:
+            addr, size = ranges[i]
+            if groups and addr <= groups[-1][1] + _MAX_COALESCE_GAP:
+                groups[-1][1] = max(groups[-1][1], addr + size)
+                groups[-1][2].append(i)
+            else:
+                groups.append([addr, addr + size, [i]])
+
+        for start, end, indexes in groups:
+            data = self._read_range(start, end - start)
+            for i in indexes:
+                addr, size = ranges[i]
+                ret[i] = data[addr - start:addr - start + size]
+
+        return ret
+
+    def write_many(self, writes):
+        """
+        Writes several ranges of guest memory at once. Adjacent or overlapping writes are merged
+        into a single KVM_MEM_RW call. When writes overlap, the last one in the list wins.
+
+        :param writes: A list of (address, data) tuples
+        """
+        for addr, data in writes:
+            self._check_range(addr, len(data))
+
+        order = sorted(range(len(writes)), key=lambda i: writes[i][0])
+
+        groups = []
+        for i in order:
+            addr, data = writes[i]
+            if groups and addr <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], addr + len(data))
+                groups[-1][2].append(i)
+            else:
+                groups.append([addr, addr + len(data), [i]])
+
+        for start, end, indexes in groups:
+            if len(indexes) == 1:
+                self._write_range(start, bytes(writes[indexes[0]][1]))
+                continue
+
+            buf = bytearray(end - start)
+            for i in sorted(indexes):
+                addr, data = writes[i]
+                buf[addr - start:addr - start + len(data)] = data
+            self._write_range(start, bytes(buf))
+
+    ##############################################################################
+    # Read cache for KVM_MEM_RW. When enabled, guest memory is fetched one page at a time and kept until
+    # the next KVM_RUN, which is the only time the guest (or the symbolic execution engine) can modify it.
+    # Writes through this class update the cache, but writes through as_array() do not.
+
+    def enable_cache(self, enabled=True):
+        self._cache_enabled = enabled
+        self._cache.clear()
+
+    def invalidate_cache(self):
+        self._cache.clear()
+
+    def _use_cache(self):
+        return self._cache_enabled and self._vm.has_mem_rw
+
+    def _read_many_cached(self, ranges):
+        needed = set()
+        for addr, size in ranges:
+            needed.update(range(addr // PAGE_SIZE, (addr + size + PAGE_SIZE - 1) // PAGE_SIZE))
+
+        missing = sorted(p for p in needed if p not in self._cache)
+
+        # Fetch runs of consecutive missing pages with a single call
+        runs = []
+        for page in missing:
+            if runs and page == runs[-1][1]:
+                runs[-1][1] += 1
+            else:
+                runs.append([page, page + 1])
+
+        for first, last in runs:
+            data = self._read_range(first * PAGE_SIZE, (last - first) * PAGE_SIZE)
+            for page in range(first, last):
+                offset = (page - first) * PAGE_SIZE
+                self._cache[page] = data[offset:offset + PAGE_SIZE]
+
+        ret = []
+        for addr, size in ranges:
+            chunks = []
+            while size:
+                page, offset = divmod(addr, PAGE_SIZE)
+                n = min(size, PAGE_SIZE - offset)
+                chunks.append(self._cache[page][offset:offset + n])
+                addr += n
+                size -= n
+            ret.append(b''.join(chunks))
+
+        return ret
+
+    def _update_cache(self, addr, data):
+        if not self._cache:
+            return
+
+        end = addr + len(data)
+        for page in range(addr // PAGE_SIZE, (end + PAGE_SIZE - 1) // PAGE_SIZE):
+            cached = self._cache.get(page)
+            if cached is None:
+                continue
+
+            page_start = page * PAGE_SIZE
+            lo = max(addr, page_start)
+            hi = min(end, page_start + PAGE_SIZE)
+            self._cache[page] = (cached[:lo - page_start] + data[lo - addr:hi - addr] +
+                                 cached[hi - page_start:])
+
+    ##############################################################################
+    # The functions below help analyzing guest memory with NumPy.
+    # They operate on the whole RAM at once and never go through Python bytes.
+
+    @property
+    def size(self):
+        return self._size
+
+    def as_array(self):
+        """
+        Returns a NumPy view of guest memory. No data is copied, writes to the array
+        go directly to the guest.
+
+        Note that the view bypasses KVM_MEM_RW. When running under libs2e, use snapshot() to get
+        consistent contents.
+        """
+        return numpy.frombuffer(self.obj, dtype=numpy.uint8)
+
+    def snapshot(self):
+        """
+        :return: A copy of the current guest memory, suitable for later diffing.
+        """
         if self._vm.has_mem_rw:
-            ret = (ctypes.c_ubyte * size)()
-            m = KVMMemRW()
-            m.source = self._pointer + addr
-            m.dest = ctypes.addressof(ret)
-            m.is_write = 0
-            m.length = size
-            fcntl.ioctl(self._vm.fd, KVM_MEM_RW, m)
-        else:
-            ret = self.obj[addr:addr+size]
+            # Read straight into the array, going through a bounce buffer would copy everything twice
+            data = numpy.empty(self._size, dtype=numpy.uint8)
+            self._mem_rw(0, data.ctypes.data, self._size, 0)
+            return data
+
+        return self.as_array().copy()
+
+    def _get_pages(self, data):
+        """
+        :return: data (or guest memory if data is None) as a 2D array of shape (page count, PAGE_SIZE)
+        """
+        if data is None:
+            # With KVM_MEM_RW, the mapping is not guest memory, which must be copied with snapshot()
+            data = self.snapshot() if self._vm.has_mem_rw else self.as_array()
+
+        if data.size != self._size:
+            raise ValueError('Expected %#x bytes of data, got %#x' % (self._size, data.size))
+
+        return data.reshape(-1, PAGE_SIZE)
+
+    def diff_pages(self, old, new=None):
+        """
+        Compares two memory snapshots page by page.
+
+        :param old: A snapshot returned by snapshot()
+        :param new: Another snapshot, or None to compare against current guest memory
+                    (which is copied first with KVM_MEM_RW)
+        :return: A NumPy array with the indices of the pages that differ
+        """
+        old_words = self._get_pages(old).view(numpy.uint64)
+        new_words = self._get_pages(new).view(numpy.uint64)
+        return numpy.flatnonzero((old_words != new_words).any(axis=1))
+
+    def page_hashes(self, data=None):
+        """
+        Computes a 64-bit fingerprint of every page. Two pages with different hashes are guaranteed to
+        be different, equal hashes mean that the pages are equal with high probability.
+        This is not a cryptographic hash.
+
+        :param data: A snapshot returned by snapshot(), or None to hash current guest memory
+                     (which is copied first with KVM_MEM_RW)
+        :return: A NumPy array of uint64 hashes, one per page
+        """
+        words = self._get_pages(data).view(numpy.uint64)
 
-        return array.array('B', ret).tostring()
+        # Integer dot products wrap around, which is what we want here
+        h = words.dot(_PAGE_HASH_MULTIPLIERS)
+
+        # Mix the bits (splitmix64 finalizer)
+        h ^= h >> numpy.uint64(30)
+        h *= numpy.uint64(0xbf58476d1ce4e5b9)
+        h ^= h >> numpy.uint64(27)
+        h *= numpy.uint64(0x94d049bb133111eb)
+        h ^= h >> numpy.uint64(31)
+        return h
+
+    def zero_pages(self, data=None):
+        """
+        :param data: A snapshot returned by snapshot(), or None to inspect current guest memory
+                     (which is copied first with KVM_MEM_RW)
+        :return: A NumPy array with the indices of the pages that contain only zeros
+        """
+        words = self._get_pages(data).view(numpy.uint64)
+        return numpy.flatnonzero(~words.any(axis=1))
+
+    def find(self, patterns, data=None):
+        """
+        Looks for all occurrences of the given byte strings. Overlapping matches are reported.
+
+        :param patterns: A list of byte strings
+        :param data: A snapshot returned by snapshot(), or None to search current guest memory
+                     (which is copied first with KVM_MEM_RW)
+        :return: A dictionary mapping each pattern to a sorted NumPy array of guest physical addresses
+        """
+        haystack = self._get_pages(data).reshape(-1)
+        needles = [numpy.frombuffer(p, dtype=numpy.uint8) for p in patterns]
+        results = dict((p, []) for p in patterns)
+
+        for start in range(0, self._size, _SEARCH_CHUNK_SIZE):
+            end = min(start + _SEARCH_CHUNK_SIZE, self._size)
+
+            # Anchor each pattern on its least frequent byte, so that the candidate list stays short even when
+            # the pattern starts with a byte that is everywhere (e.g., zeros). A sample is enough to estimate
+            # byte frequencies, picking a suboptimal anchor only costs time.
+            histogram = numpy.bincount(haystack[start:end:_SEARCH_SAMPLE_STRIDE], minlength=256)
+
+            for pattern, needle in zip(patterns, needles):
+                if not needle.size or needle.size > self._size:
+                    continue
+
+                # Only matches starting in [start, end) belong to this chunk
+                last = min(end, self._size - needle.size + 1)
+                if last <= start:
+                    continue
+
+                anchor = int(numpy.argmin(histogram[needle]))
+                candidates = numpy.flatnonzero(haystack[start + anchor:last + anchor] == needle[anchor]) + start
+                for i in range(needle.size):
+                    if not candidates.size:
+                        break
+                    if i != anchor:
+                        candidates = candidates[haystack[candidates + i] == needle[i]]
+
+                results[pattern].append(candidates)
+
+        return dict(
+            (p, numpy.concatenate(r) if r else numpy.empty(0, dtype=numpy.intp)) for p, r in results.items()
+        )
 
 
 def _get_32bit_code_segment():
@@ -159,9 +527,36 @@ def _get_32bit_data_segment():
 
 
 # TODO: clean up all resources
+def _on_force_exit_signal(*_):
+    # The signal only needs to interrupt KVM_RUN, VCPU.force_exit() already recorded the request
+    pass
+
+
+def install_force_exit_handler():
+    """
+    Installs a handler for FORCE_EXIT_SIGNAL, unless the process already has one. Without it, the signal
+    would terminate the process. Python only lets the main thread install signal handlers: VCPU does
+    this automatically when it is created or run in the main thread, programs that only use VMs from
+    other threads must call this function from the main thread themselves.
+
+    :return: True if a handler is installed
+    """
+    if signal.getsignal(FORCE_EXIT_SIGNAL) != signal.SIG_DFL:
+        return True
+
+    try:
+        signal.signal(FORCE_EXIT_SIGNAL, _on_force_exit_signal)
+    except ValueError:
+        # Not the main thread
+        return False
+
+    return True
+
+
 class VCPU(object):
-    def __init__(self, kvm_fd, vm_fd):
+    def __init__(self, kvm_fd, vm_fd, has_force_exit=False):
         self._vm_fd = vm_fd
+        self._has_force_exit = has_force_exit
 
         self._vcpu_fd = fcntl.ioctl(vm_fd, KVM_CREATE_VCPU)
         logger.debug('Created VCPU fd=%d', self._vcpu_fd)
@@ -174,6 +569,77 @@ class VCPU(object):
         self._pointer = mmap.mmap(self._vcpu_fd, self._vcpu_size)
         self._run_obj = KVMRun.from_buffer(self._pointer)
 
+        self._io_handlers = {}
+        self._exit_handlers = {}
+        self._pre_run_handlers = []
+
+        # Set by force_exit(), possibly from another thread
+        self._exit_requested = False
+        self._thread_id = None
+
+        install_force_exit_handler()
+
+    def close(self):
+        # The kvm_run structure must go first, the mapping cannot be closed while it is referenced
+        self._run_obj = None
+        self._pointer.close()
+        os.close(self._vcpu_fd)
+
+    def register_io_handler(self, port, handler):
+        """
+        Registers a function that handles guest accesses to the given I/O port.
+        The handler gets the KVMRunExitIO structure and execution resumes when it returns.
+        """
+        if port in self._io_handlers:
+            raise RuntimeError('I/O port %#x already has a handler' % port)
+
+        self._io_handlers[port] = handler
+
+    def register_exit_handler(self, reason, handler):
+        """
+        Registers a function that handles the given exit reason instead of the default behavior.
+        The handler takes no arguments and execution resumes when it returns.
+        """
+        if reason in self._exit_handlers:
+            raise RuntimeError('%s already has a handler' % reason)
+
+        self._exit_handlers[reason] = handler
+
+    def register_pre_run_handler(self, handler):
+        """
+        Registers a function to call every time before entering the guest with KVM_RUN.
+        """
+        self._pre_run_handlers.append(handler)
+
+    def force_exit(self):
+        """
+        Makes the current (or next) KVM_RUN return as soon as possible, run() then returns KVM_EXIT_INTR.
+        This is meant to be called from a signal handler or another thread.
+
+        With KVM_CAP_FORCE_EXIT, this relies on the S2E extension. Otherwise, this sets immediate_exit in
+        the kvm_run structure and sends FORCE_EXIT_SIGNAL to the thread that is in run(). If no handler is
+        installed for that signal (see install_force_exit_handler()), the signal is not sent, and the guest
+        only stops at its next exit to PyKVM.
+        """
+        self._exit_requested = True
+
+        if self._has_force_exit:
+            fcntl.ioctl(self._vcpu_fd, KVM_FORCE_EXIT)
+            return
+
+        self._run_obj.immediate_exit = 1
+
+        thread_id = self._thread_id
+        if thread_id is None or not hasattr(signal, 'pthread_kill'):
+            return
+
+        # The default action would terminate the whole process
+        if signal.getsignal(FORCE_EXIT_SIGNAL) == signal.SIG_DFL:
+            logger.warning('No handler for signal %d, the guest will stop at its next exit', FORCE_EXIT_SIGNAL)
+            return
+
+        signal.pthread_kill(thread_id, FORCE_EXIT_SIGNAL)
+
     def init_state(self, rip=0, rsp=0, bits=32):
         sregs = KVMSRegs()
         fcntl.ioctl(self._vcpu_fd, KVM_GET_SREGS, sregs)
@@ -217,35 +683,151 @@ class VCPU(object):
         logger.info('rsi=%#lx rdi=%#lx rbp=%#lx rsp=%#lx', regs.rsi, regs.rdi, regs.rbp, regs.rsp)
         logger.info('rip=%#lx', regs.rip)
 
-    # pylint: disable=too-many-branches
+    def get_regs(self):
+        regs = KVMRegs()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_REGS, regs)
+        return regs
+
+    def set_regs(self, regs):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_REGS, regs)
+
+    def get_sregs(self):
+        sregs = KVMSRegs()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_SREGS, sregs)
+        return sregs
+
+    def set_sregs(self, sregs):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_SREGS, sregs)
+
+    def get_fpu(self):
+        fpu = KVMFpu()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_FPU, fpu)
+        return fpu
+
+    def set_fpu(self, fpu):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_FPU, fpu)
+
+    def get_xsave(self):
+        """
+        Requires KVM_CAP_XSAVE. Unlike get_fpu(), this includes the upper halves of the AVX registers.
+        """
+        xsave = KVMXsave()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_XSAVE, xsave)
+        return xsave
+
+    def set_xsave(self, xsave):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_XSAVE, xsave)
+
+    def get_xcrs(self):
+        """
+        Requires KVM_CAP_XCRS.
+        """
+        xcrs = KVMXcrs()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_XCRS, xcrs)
+        return xcrs
+
+    def set_xcrs(self, xcrs):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_XCRS, xcrs)
+
+    def get_debugregs(self):
+        """
+        Requires KVM_CAP_DEBUGREGS.
+        """
+        debugregs = KVMDebugRegs()
+        fcntl.ioctl(self._vcpu_fd, KVM_GET_DEBUGREGS, debugregs)
+        return debugregs
+
+    def set_debugregs(self, debugregs):
+        fcntl.ioctl(self._vcpu_fd, KVM_SET_DEBUGREGS, debugregs)
+
+    def get_msrs(self, indices):
+        """
+        :param indices: The MSRs to read, see get_supported_msrs()
+        :return: A dictionary mapping the index of each MSR to its value
+        """
+        msrs = make_kvm_msrs(len(indices))
+        for entry, index in zip(msrs.entries, indices):
+            entry.index = index
+
+        count = fcntl.ioctl(self._vcpu_fd, KVM_GET_MSRS, msrs)
+        if count != len(indices):
+            raise RuntimeError('Could not read MSR %#x' % indices[count])
+
+        return dict((entry.index, entry.data) for entry in msrs.entries)
+
+    def set_msrs(self, values):
+        """
+        :param values: A dictionary mapping the index of each MSR to its new value
+        """
+        msrs = make_kvm_msrs(len(values))
+        for entry, (index, data) in zip(msrs.entries, sorted(values.items())):
+            entry.index = index
+            entry.data = data
+
+        count = fcntl.ioctl(self._vcpu_fd, KVM_SET_MSRS, msrs)
+        if count != len(values):
+            raise RuntimeError('Could not write MSR %#x' % msrs.entries[count].index)
+
     def run(self):
         """
         Runs the virtual machine until an exit condition occurs.
         One way to terminate execution is for the guest to execute the HLT instruction.
-        We don't support I/O, MMIO, and some other cases, so this function will terminate when it encounters them.
+        Returns the exit reason that terminated execution.
+        We don't support MMIO and some other cases, so this function will terminate when it encounters them.
+        I/O to ports that have no handler also terminates execution, as does force_exit().
         """
 
         logger.info('Running KVM')
 
+        install_force_exit_handler()
+        self._thread_id = threading.current_thread().ident
+        try:
+            return self._run()
+        finally:
+            self._thread_id = None
+
+    # pylint: disable=too-many-branches
+    def _run(self):
         while True:
+            for handler in self._pre_run_handlers:
+                handler()
+
             try:
                 fcntl.ioctl(self._vcpu_fd, KVM_RUN)
             except IOError as e:
                 if e.errno != errno.EINTR:
                     raise
 
+            if self._exit_requested:
+                # KVM_RUN may have returned without entering the guest, so exit_reason is not reliable
+                self._exit_requested = False
+                self._run_obj.immediate_exit = 0
+                reason = KVMExitReason.KVM_EXIT_INTR
+                logger.info('Forced exit')
+                break
+
             reason = KVMExitReason(self._run_obj.exit_reason)
 
+            handler = self._exit_handlers.get(reason)
+            if handler is not None:
+                handler()
+                continue
+
             if reason == KVMExitReason.KVM_EXIT_INTERNAL_ERROR:
                 # KVM encountered an internal fault. This usually happens when the guest tries
                 # to execute some garbage (triple faults, reboots, invalid instructions, etc.).
                 raise RuntimeError(KVMInternalError(self._run_obj.exit_reasons.internal.suberror))
             elif reason == KVMExitReason.KVM_EXIT_IO:
                 # Triggered when the guest executes an IO instruction (e.g., inp, outb on x86)
-                # These I/O ports belong to virtual devices. We terminate execution when this happens as
-                # we don't support virtual devices yet.
-                logger.info('%s %s', reason, self._run_obj.exit_reasons.io)
-                break
+                # These I/O ports belong to virtual devices. We terminate execution when this happens
+                # unless somebody registered a handler for the port (e.g., the hypercall ring).
+                io = self._run_obj.exit_reasons.io
+                handler = self._io_handlers.get(io.port)
+                if handler is None:
+                    logger.info('%s %s', reason, io)
+                    break
+
+                handler(io)
             elif reason == KVMExitReason.KVM_EXIT_MMIO:
                 # An MMIO exit event is triggered when the guest accesses unmapped physical memory.
                 # This memory typically belongs to virtual devices. We terminate execution when this happens as
@@ -272,16 +854,26 @@ class VCPU(object):
                 # We don't have any device state to restore for symbolic execution
                 pass
             elif reason == KVMExitReason.KVM_EXIT_CLONE_PROCESS:
+                # The VM class handles this one, a bare VCPU cannot know which state to re-create
                 raise RuntimeError('Multi-core mode not supported')
             else:
                 raise RuntimeError('Unhandled exit code %s' % reason)
 
+        return reason
+
+
+# Capabilities only depend on the KVM implementation, so they are probed once per process
+_capabilities = {}
+
 
 def has_capability(kvm_fd, cap):
     """
     Determines if the KVM implementation has the requested capability.
     :return A non-zero value if the capability is supported.
     """
+    if cap in _capabilities:
+        return _capabilities[cap]
+
     ret = 0
 
     try:
@@ -291,9 +883,27 @@ def has_capability(kvm_fd, cap):
     finally:
         logger.info('%s: %d', cap, ret)
 
+    _capabilities[cap] = ret
     return ret
 
 
+def get_supported_msrs(kvm_fd):
+    """
+    :return: The indices of the MSRs that KVM lets the client read and write
+    """
+    msr_list = make_kvm_msr_list(0)
+    try:
+        fcntl.ioctl(kvm_fd, KVM_GET_MSR_INDEX_LIST, msr_list)
+    except IOError as e:
+        # Expected, KVM stores the number of MSRs in msr_list
+        if e.errno != errno.E2BIG:
+            raise
+
+    msr_list = make_kvm_msr_list(msr_list.nmsrs)
+    fcntl.ioctl(kvm_fd, KVM_GET_MSR_INDEX_LIST, msr_list)
+    return list(msr_list.indices)
+
+
 class VM(object):
     """
     This class represents a VM, composed of some guest RAM and one CPU.
@@ -303,6 +913,18 @@ class VM(object):
     def __init__(self, kvm_fd, ram_size):
         self.has_mem_fixed_region = has_capability(kvm_fd, KVMCapability.KVM_CAP_MEM_FIXED_REGION)
         self.has_mem_rw = has_capability(kvm_fd, KVMCapability.KVM_CAP_MEM_RW)
+        self.has_force_exit = has_capability(kvm_fd, KVMCapability.KVM_CAP_FORCE_EXIT)
+        self.has_disk_rw = has_capability(kvm_fd, KVMCapability.KVM_CAP_DISK_RW)
+        self.has_dev_snapshot = has_capability(kvm_fd, KVMCapability.KVM_CAP_DEV_SNAPSHOT)
+        self.has_clock_scale = has_capability(kvm_fd, KVMCapability.KVM_CAP_CPU_CLOCK_SCALE)
+        self.has_xsave = has_capability(kvm_fd, KVMCapability.KVM_CAP_XSAVE)
+        self.has_xcrs = has_capability(kvm_fd, KVMCapability.KVM_CAP_XCRS)
+        self.has_debugregs = has_capability(kvm_fd, KVMCapability.KVM_CAP_DEBUGREGS)
+
+        self._devices = []
+        self._clone_handlers = []
+        self._clock_scale = ctypes.c_uint32(1)
+        self.pid = os.getpid()
 
         self._vm_fd = fcntl.ioctl(kvm_fd, KVM_CREATE_VM)
         self._ram = RAM(ram_size, self)
@@ -310,7 +932,7 @@ class VM(object):
 
         if self.has_mem_fixed_region:
             fixed_region = KVMFixedRegion()
-            fixed_region.name = 'ram'
+            fixed_region.name = b'ram'
             fixed_region.host_address = kvm_region.userspace_addr
             fixed_region.size = kvm_region.memory_size
             fixed_region.flags = 0
@@ -319,14 +941,147 @@ class VM(object):
 
         fcntl.ioctl(self._vm_fd, KVM_SET_USER_MEMORY_REGION, kvm_region)
 
-        self._vcpu = VCPU(kvm_fd, self._vm_fd)
+        self._vcpu = VCPU(kvm_fd, self._vm_fd, self.has_force_exit)
         self._vcpu.init_state()
 
+        self._vcpu.register_pre_run_handler(self._ram.invalidate_cache)
+        self._vcpu.register_exit_handler(KVMExitReason.KVM_EXIT_CLONE_PROCESS, self._on_clone_process)
+        if self.has_dev_snapshot:
+            self._vcpu.register_exit_handler(KVMExitReason.KVM_EXIT_SAVE_DEV_STATE, self._save_device_state)
+            self._vcpu.register_exit_handler(KVMExitReason.KVM_EXIT_RESTORE_DEV_STATE, self._restore_device_state)
+
     def run(self):
         """
         Run the VM. See documentation in the VCPU class for details.
         """
-        self._vcpu.run()
+        return self._vcpu.run()
+
+    def close(self):
+        """
+        Destroys the VM and releases its file descriptors and guest memory.
+        """
+        self._vcpu.close()
+        os.close(self._vm_fd)
+        self._ram.close()
+
+    def register_io_handler(self, port, handler):
+        self._vcpu.register_io_handler(port, handler)
+
+    def register_device(self, save, restore):
+        """
+        Registers host-side state that must follow the guest when the symbolic execution engine
+        switches between execution paths. save() returns the state as bytes, restore(data) loads it back.
+        """
+        self._devices.append((save, restore))
+
+    def register_clone_handler(self, handler):
+        """
+        Registers a function to call in the new process after the symbolic execution engine forks the
+        client (KVM_EXIT_CLONE_PROCESS). This is where per-process state (threads, file descriptors,
+        caches, etc.) must be re-created. The handler takes no arguments.
+        """
+        self._clone_handlers.append(handler)
+
+    def _on_clone_process(self):
+        parent = self.pid
+        self.pid = os.getpid()
+        logger.info('Process %d cloned into %d', parent, self.pid)
+
+        for handler in self._clone_handlers:
+            handler()
+
+    def _save_device_state(self):
+        # The blob starts with its total size and the number of devices,
+        # followed by the state of each device prefixed with its size.
+        blob = b''.join(struct.pack('<I', len(data)) + data for data in (save() for save, _ in self._devices))
+        blob = struct.pack('<II', len(blob) + 4, len(self._devices)) + blob
+
+        buf = ctypes.create_string_buffer(blob, len(blob))
+        s = KVMDevSnapshot()
+        s.buffer = ctypes.addressof(buf)
+        s.size = len(blob)
+        s.pos = 0
+        s.is_write = 1
+        fcntl.ioctl(self._vm_fd, KVM_DEV_SNAPSHOT, s)
+        logger.debug('Saved %d bytes of device state', len(blob))
+
+    def _read_device_snapshot(self, pos, size):
+        buf = ctypes.create_string_buffer(size)
+        s = KVMDevSnapshot()
+        s.buffer = ctypes.addressof(buf)
+        s.size = size
+        s.pos = pos
+        s.is_write = 0
+        fcntl.ioctl(self._vm_fd, KVM_DEV_SNAPSHOT, s)
+        return buf.raw
+
+    def _restore_device_state(self):
+        size, = struct.unpack('<I', self._read_device_snapshot(0, 4))
+        blob = self._read_device_snapshot(4, size)
+
+        count, = struct.unpack_from('<I', blob, 0)
+        if count != len(self._devices):
+            raise RuntimeError('Device state was saved with %d devices, but %d are registered' %
+                               (count, len(self._devices)))
+
+        offset = 4
+        for _, restore in self._devices:
+            length, = struct.unpack_from('<I', blob, offset)
+            offset += 4
+            if offset + length > len(blob):
+                raise RuntimeError('Truncated device state')
+            restore(blob[offset:offset + length])
+            offset += length
+
+        logger.debug('Restored %d bytes of device state', size + 4)
+
+    def register_clock_scale(self):
+        """
+        Gives the symbolic execution engine a pointer to the clock scale factor, which it updates
+        when execution slows down (e.g., in symbolic mode). Requires KVM_CAP_CPU_CLOCK_SCALE.
+        """
+        # The engine keeps the pointer, so pass the address of a variable that lives as long as the VM
+        fcntl.ioctl(self._vm_fd, KVM_SET_CLOCK_SCALE, ctypes.addressof(self._clock_scale))
+
+    @property
+    def clock_scale(self):
+        """
+        :return: The factor by which the guest clock must currently be slowed down
+        """
+        return self._clock_scale.value
+
+    def _disk_rw(self, sector, buf, is_write):
+        if len(buf) % SECTOR_SIZE:
+            raise ValueError('Disk buffers must be a multiple of %d bytes' % SECTOR_SIZE)
+
+        d = KVMDiskRW()
+        d.host_address = ctypes.addressof(buf)
+        d.sector = sector
+        d.count = len(buf) // SECTOR_SIZE
+        d.is_write = is_write
+        fcntl.ioctl(self._vm_fd, KVM_DISK_RW, d)
+        return d.count
+
+    def disk_read(self, sector, data):
+        """
+        Lets the symbolic execution engine overlay the disk writes made by the current path
+        on top of data, which the client read from its disk image. Requires KVM_CAP_DISK_RW.
+
+        :return: The data the guest must see
+        """
+        buf = ctypes.create_string_buffer(data, len(data))
+        self._disk_rw(sector, buf, 0)
+        return buf.raw
+
+    def disk_write(self, sector, data):
+        """
+        Hands a guest disk write to the symbolic execution engine, which keeps it private to the
+        current path instead of writing it to the disk image. Requires KVM_CAP_DISK_RW.
+
+        :return: The number of sectors written
+        """
+        buf = ctypes.create_string_buffer(data, len(data))
+        return self._disk_rw(sector, buf, 1)
 
     @property
     def ram(self):
@@ -366,6 +1121,10 @@ def main():
     parser.add_argument('--org', type=lambda x: int(x, 0), default=0x0, help='Load base of the binary')
     parser.add_argument('--dump', type=lambda x: int(x, 0), default=0x1000, help='Address to dump when complete')
     parser.add_argument('--dump-size', type=lambda x: int(x, 0), default=0x100, help='How many bytes to dump')
+    parser.add_argument('--diff', action='store_true', help='Show which pages the binary modified')
+    parser.add_argument('--ring', action='store_true', help='Enable the hypercall ring (see sample/pykvm.h)')
+    parser.add_argument('--ring-addr', type=lambda x: int(x, 0), default=HYPERCALL_RING_ADDR,
+                        help='Address of the hypercall ring')
     parser.add_argument('binary', nargs=1, help='Raw binary file to load and execute (32-bit x86)')
     args = parser.parse_args()
 
@@ -381,6 +1140,8 @@ def main():
     vm = VM(fp, args.memsize)
     vm.vcpu.init_state(rip=args.rip, rsp=args.rsp, bits=32)
 
+    ring = HypercallRing(vm, args.ring_addr) if args.ring else None
+
     # Load the input binary into memory
     with open(args.binary[0], 'rb') as fp:
         logger.info('Writing binary to offset %#x', args.org)
@@ -389,10 +1150,20 @@ def main():
     logger.info('Binary before execution')
     hexdump(vm.ram.read(args.org, 0x100))
 
+    before = vm.ram.snapshot() if args.diff else None
+
     vm.run()
 
     vm.vcpu.dump_regs()
 
+    if args.diff:
+        for page in vm.ram.diff_pages(before, vm.ram.snapshot()):
+            logger.info('Page %#lx was modified', page * PAGE_SIZE)
+
+    if ring is not None:
+        logger.info('Guest output (%d bytes)', len(ring.output))
+        hexdump(bytes(ring.output))
+
     logger.info('Dumping address %#lx of size %#lx', args.dump, args.dump_size)
     hexdump(vm.ram.read(args.dump, args.dump_size))
 
@@ -18,10 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from ctypes import Structure, Union, c_uint8, c_uint16, c_uint32, c_uint64, c_char_p
+from ctypes import Structure, Union, c_uint8, c_uint16, c_uint32, c_uint64, c_char_p, c_void_p
 from enum import IntEnum
 
-from ioctl_opt import IO, IOW, IOR
+from ioctl_opt import IO, IOW, IOR, IOWR
 
 
 class KVMUserSpaceMemoryRegion(Structure):
@@ -117,10 +117,103 @@ class KVMSRegs(Structure):
 
         ('efer', c_uint64),
         ('apic_base', c_uint64),
-        ('interrupt_bitmap', c_uint64 * ((KVM_NR_INTERRUPTS + 63) / 64)),
+        ('interrupt_bitmap', c_uint64 * ((KVM_NR_INTERRUPTS + 63) // 64)),
     ]
 
 
+class KVMFpu(Structure):
+    _fields_ = [
+        ('fpr', (c_uint8 * 16) * 8),
+        ('fcw', c_uint16),
+        ('fsw', c_uint16),
+        ('ftwx', c_uint8),
+        ('pad1', c_uint8),
+        ('last_opcode', c_uint16),
+        ('last_ip', c_uint64),
+        ('last_dp', c_uint64),
+        ('xmm', (c_uint8 * 16) * 16),
+        ('mxcsr', c_uint32),
+        ('pad2', c_uint32),
+    ]
+
+
+class KVMXsave(Structure):
+    _fields_ = [
+        ('region', c_uint32 * 1024),
+    ]
+
+
+class KVMXcr(Structure):
+    _fields_ = [
+        ('xcr', c_uint32),
+        ('reserved', c_uint32),
+        ('value', c_uint64),
+    ]
+
+
+KVM_MAX_XCRS = 16
+
+
+class KVMXcrs(Structure):
+    _fields_ = [
+        ('nr_xcrs', c_uint32),
+        ('flags', c_uint32),
+        ('xcrs', KVMXcr * KVM_MAX_XCRS),
+        ('padding', c_uint64 * 16),
+    ]
+
+
+class KVMDebugRegs(Structure):
+    _fields_ = [
+        ('db', c_uint64 * 4),
+        ('dr6', c_uint64),
+        ('dr7', c_uint64),
+        ('flags', c_uint64),
+        ('reserved', c_uint64 * 9),
+    ]
+
+
+class KVMMsrEntry(Structure):
+    _fields_ = [
+        ('index', c_uint32),
+        ('reserved', c_uint32),
+        ('data', c_uint64),
+    ]
+
+
+# Header of the variable-size kvm_msrs and kvm_msr_list structures, use make_kvm_msrs() and
+# make_kvm_msr_list() to allocate them
+class KVMMsrs(Structure):
+    _fields_ = [
+        ('nmsrs', c_uint32),
+        ('pad', c_uint32),
+    ]
+
+
+class KVMMsrList(Structure):
+    _fields_ = [
+        ('nmsrs', c_uint32),
+    ]
+
+
+def make_kvm_msrs(count):
+    class _KVMMsrs(Structure):
+        _fields_ = KVMMsrs._fields_ + [('entries', KVMMsrEntry * count)]
+
+    msrs = _KVMMsrs()
+    msrs.nmsrs = count
+    return msrs
+
+
+def make_kvm_msr_list(count):
+    class _KVMMsrList(Structure):
+        _fields_ = KVMMsrList._fields_ + [('indices', c_uint32 * count)]
+
+    msr_list = _KVMMsrList()
+    msr_list.nmsrs = count
+    return msr_list
+
+
 class KVMInternalError(IntEnum):
     KVM_INTERNAL_ERROR_EMULATION = 1
     KVM_INTERNAL_ERROR_SIMUL_EX = 2
@@ -172,8 +265,10 @@ class KVMExitReason(IntEnum):
 
 
 class KVMCapability(IntEnum):
-    # TODO: add generic KVM capabilities
-    # ...
+    # TODO: add remaining generic KVM capabilities
+    KVM_CAP_DEBUGREGS = 50
+    KVM_CAP_XSAVE = 55
+    KVM_CAP_XCRS = 56
 
     # The following capabilities are specific to libs2e.
     # They are required for multi-path symbolic execution support.
@@ -202,6 +297,11 @@ class KVMRunExitMMIO(Structure):
         )
 
 
+class KVMExitIODirection(IntEnum):
+    KVM_EXIT_IO_IN = 0
+    KVM_EXIT_IO_OUT = 1
+
+
 class KVMRunExitIO(Structure):
     _fields_ = [
         ('direction', c_uint8),
@@ -244,7 +344,8 @@ class KVMRun(Structure):
     _fields_ = [
         # Input
         ('request_interrupt_window', c_uint8),
-        ('padding1', c_uint8 * 7),
+        ('immediate_exit', c_uint8),
+        ('padding1', c_uint8 * 6),
 
         # Output
         ('exit_reason', c_uint32),
@@ -265,6 +366,7 @@ KVMIO = 0xae
 # KVM IOCTLs
 KVM_GET_API_VERSION = IO(KVMIO, 0x00)
 KVM_CREATE_VM = IO(KVMIO, 0x01)
+KVM_GET_MSR_INDEX_LIST = IOWR(KVMIO, 0x02, KVMMsrList)
 KVM_CHECK_EXTENSION = IO(KVMIO, 0x03)
 KVM_GET_VCPU_MMAP_SIZE = IO(KVMIO, 0x04)
 
@@ -280,10 +382,43 @@ KVM_GET_REGS = IOR(KVMIO, 0x81, KVMRegs)
 KVM_SET_REGS = IOW(KVMIO, 0x82, KVMRegs)
 KVM_GET_SREGS = IOR(KVMIO, 0x83, KVMSRegs)
 KVM_SET_SREGS = IOW(KVMIO, 0x84, KVMSRegs)
+KVM_GET_MSRS = IOWR(KVMIO, 0x88, KVMMsrs)
+KVM_SET_MSRS = IOW(KVMIO, 0x89, KVMMsrs)
+KVM_GET_FPU = IOR(KVMIO, 0x8c, KVMFpu)
+KVM_SET_FPU = IOW(KVMIO, 0x8d, KVMFpu)
+KVM_GET_DEBUGREGS = IOR(KVMIO, 0xa1, KVMDebugRegs)
+KVM_SET_DEBUGREGS = IOW(KVMIO, 0xa2, KVMDebugRegs)
+KVM_GET_XSAVE = IOR(KVMIO, 0xa4, KVMXsave)
+KVM_SET_XSAVE = IOW(KVMIO, 0xa5, KVMXsave)
+KVM_GET_XCRS = IOR(KVMIO, 0xa6, KVMXcrs)
+KVM_SET_XCRS = IOW(KVMIO, 0xa7, KVMXcrs)
 
 #########################################################################################
 # The KVM structures and APIs below are not part of the standard KVM interface.
 # They are part of the KVM extensions for symbolic execution by S2E (http://s2e.systems).
+# The ioctl numbers and directions must match the S2E additions to linux-headers/linux/kvm.h
+# in S2E's QEMU fork (https://github.com/S2E/qemu), which libs2e implements.
+
+
+# Available with KVM_CAP_MEM_RW
+class KVMMemRW(Structure):
+    _fields_ = [
+        # source and dest are always host pointers
+        ('source', c_uint64),
+        ('dest', c_uint64),
+        ('is_write', c_uint64),
+        ('length', c_uint64),
+    ]
+
+
+# _IOW(KVMIO, 0xf3, struct kvm_mem_rw)
+KVM_MEM_RW = IOW(KVMIO, 0xf3, KVMMemRW)
+
+
+# Available with KVM_CAP_FORCE_EXIT
+# Makes a running KVM_RUN return to the client as soon as possible
+# _IO(KVMIO, 0xf4)
+KVM_FORCE_EXIT = IO(KVMIO, 0xf4)
 
 
 # Available with KVM_CAP_MEM_FIXED_REGION
@@ -296,24 +431,49 @@ class KVMFixedRegion(Structure):
     ]
 
 
+# _IOW(KVMIO, 0xf5, struct kvm_fixed_region)
 KVM_MEM_REGISTER_FIXED_REGION = IOW(KVMIO, 0xf5, KVMFixedRegion)
 
 
-# Available with KVM_CAP_MEM_RW
-class KVMMemRW(Structure):
+# Available with KVM_CAP_DISK_RW
+class KVMDiskRW(Structure):
     _fields_ = [
-        # source and dest are always host pointers
-        ('source', c_uint64),
-        ('dest', c_uint64),
-        ('is_write', c_uint64),
-        ('length', c_uint64),
+        # Address of the buffer in host memory
+        ('host_address', c_uint64),
+
+        # 512-byte sectors
+        ('sector', c_uint64),
+
+        # Input: sectors to read/write, output: sectors read/written
+        ('count', c_uint32),
+        ('is_write', c_uint8),
     ]
 
 
-KVM_MEM_RW = IOW(KVMIO, 0xf3, KVMMemRW)
+# _IOWR(KVMIO, 0xf6, struct kvm_disk_rw)
+KVM_DISK_RW = IOWR(KVMIO, 0xf6, KVMDiskRW)
+
+
+# Available with KVM_CAP_CPU_CLOCK_SCALE
+# The argument is a pointer to an unsigned int. S2E keeps the pointer and stores there
+# the factor by which the guest clock must currently be slowed down.
+# _IOWR(KVMIO, 0xf7, unsigned *)
+KVM_SET_CLOCK_SCALE = IOWR(KVMIO, 0xf7, c_void_p)
+
+
+# Available with KVM_CAP_DEV_SNAPSHOT
+class KVMDevSnapshot(Structure):
+    _fields_ = [
+        ('buffer', c_uint64),
+
+        # If is_write == 0, indicates expected size in case of error
+        ('size', c_uint32),
+
+        # Only when is_write == 0, indicates the position from which reading the state
+        ('pos', c_uint32),
+        ('is_write', c_uint8),
+    ]
+
 
-# TODO: implement remaining symbolic execution extensions
-# KVM_FORCE_EXIT
-# KVM_DISK_RW
-# KVM_DEV_SNAPSHOT
-# KVM_SET_CLOCK_SCALE
+# _IOWR(KVMIO, 0xf8, struct kvm_dev_snapshot)
+KVM_DEV_SNAPSHOT = IOWR(KVMIO, 0xf8, KVMDevSnapshot)
@@ -0,0 +1,85 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Wire format shared by the PyKVM server and client.
+
+Every message is made of a small fixed header (two little-endian 32-bit integers) with the sizes of the two parts
+that follow: a JSON object describing the message and an optional binary payload (binary to run, memory dump, etc.).
+
+The client sends jobs:
+
+    {"type": "job", "binary": <path or null>, "memsize": ..., "rip": ..., "rsp": ..., "org": ...,
+     "dump": [[addr, size], ...], "ring": <address or null>, "timeout": <seconds or null>}
+
+When "binary" is null, the payload holds the contents of the binary. When "timeout" is null,
+the default timeout of the server applies, if any.
+
+The server answers every job with one message per requested range, whose payload holds the memory:
+
+    {"type": "dump", "addr": ..., "size": ...}
+
+followed by either
+
+    {"type": "done", "exit_reason": <name of the KVMExitReason>, "timed_out": <true or false>,
+     "regs": {"rax": ..., "rbx": ..., ..., "rip": ..., "rflags": ...}}
+
+whose payload holds the output of the guest through the hypercall ring (empty without a ring), or
+
+    {"type": "error", "message": <description of the failure>}
+"""
+
+import json
+import struct
+
+DEFAULT_SOCKET = '/tmp/pykvm.sock'
+
+_HEADER = struct.Struct('<II')
+
+
+def send_message(sock, message, payload=b''):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data), len(payload)) + data + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """
+    :return: A (message, payload) tuple, or (None, None) if the peer closed the connection
+    """
+    try:
+        header = _recv_exactly(sock, _HEADER.size)
+    except EOFError:
+        return None, None
+
+    message_size, payload_size = _HEADER.unpack(header)
+    message = json.loads(_recv_exactly(sock, message_size).decode('utf-8'))
+    payload = _recv_exactly(sock, payload_size)
+    return message, payload
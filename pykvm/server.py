@@ -0,0 +1,348 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Long-running PyKVM server. It listens on a Unix socket and runs the binaries sent by pykvm.client.
+VMs are kept in a pool and reused across jobs, so a job does not pay for process startup,
+imports, capability probing, or VM creation.
+
+This only makes sense with native KVM. libs2e terminates the process when symbolic execution completes.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+from argparse import ArgumentParser
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from pykvm.hypercall import HypercallRing
+from pykvm.kvm import VM, PAGE_SIZE, get_supported_msrs, install_force_exit_handler
+from pykvm.kvm_types import KVMExitReason, KVMRegs, KVM_GET_API_VERSION
+from pykvm.protocol import DEFAULT_SOCKET, send_message, recv_message
+
+logger = logging.getLogger(__name__)
+
+# Limits on what clients can make the server allocate
+DEFAULT_MAX_MEMSIZE = 0x40000000
+DEFAULT_MAX_IDLE_VMS = 4
+
+
+# MSRs that guest code running at CPL0 can change, and that would otherwise leak into the next job
+_RESET_MSRS = [
+    0x10,  # IA32_TIME_STAMP_COUNTER
+    0x174,  # IA32_SYSENTER_CS
+    0x175,  # IA32_SYSENTER_ESP
+    0x176,  # IA32_SYSENTER_EIP
+    0x277,  # IA32_PAT
+    0xc0000081,  # STAR
+    0xc0000082,  # LSTAR
+    0xc0000083,  # CSTAR
+    0xc0000084,  # SFMASK
+    0xc0000102,  # KERNEL_GS_BASE
+    0xc0000103,  # TSC_AUX
+]
+
+
+class _PooledVM(object):
+    def __init__(self, kvm_fd, memsize, ring_addr, msrs):
+        self.vm = VM(kvm_fd, memsize)
+
+        try:
+            self.ring = HypercallRing(self.vm, ring_addr) if ring_addr is not None else None
+
+            # Restored before every job. This covers the state that the binaries we run can reach,
+            # but not everything KVM keeps (e.g., other MSRs or pending events).
+            vcpu = self.vm.vcpu
+            self.initial_sregs = vcpu.get_sregs()
+            self.initial_fpu = vcpu.get_fpu()
+            self.initial_xsave = vcpu.get_xsave() if self.vm.has_xsave else None
+            self.initial_xcrs = vcpu.get_xcrs() if self.vm.has_xcrs else None
+            self.initial_debugregs = vcpu.get_debugregs() if self.vm.has_debugregs else None
+            self.initial_msrs = vcpu.get_msrs(msrs)
+        except Exception:
+            self.vm.close()
+            raise
+
+    def reset(self, rip, rsp):
+        vcpu = self.vm.vcpu
+
+        self.vm.ram.clear()
+        vcpu.set_sregs(self.initial_sregs)
+        vcpu.set_regs(KVMRegs())
+
+        # XCR0 selects the parts of the XSAVE area that are valid, so it goes first
+        if self.initial_xcrs is not None:
+            vcpu.set_xcrs(self.initial_xcrs)
+
+        # The XSAVE area includes the FPU state, and the upper halves of the AVX registers that KVM_SET_FPU misses
+        if self.initial_xsave is not None:
+            vcpu.set_xsave(self.initial_xsave)
+        else:
+            vcpu.set_fpu(self.initial_fpu)
+
+        if self.initial_debugregs is not None:
+            vcpu.set_debugregs(self.initial_debugregs)
+
+        vcpu.set_msrs(self.initial_msrs)
+        vcpu.init_state(rip=rip, rsp=rsp, bits=32)
+
+        if self.ring is not None:
+            self.ring.reset()
+
+    def close(self):
+        self.vm.close()
+
+
+class VMPool(object):
+    """
+    Idle VMs, indexed by memory size and hypercall ring address.
+    At most max_idle VMs are kept for each key, the others are destroyed when released.
+    """
+
+    def __init__(self, kvm_fd, max_idle=DEFAULT_MAX_IDLE_VMS):
+        self._kvm_fd = kvm_fd
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._closed = False
+
+        supported = set(get_supported_msrs(kvm_fd))
+        self._msrs = [msr for msr in _RESET_MSRS if msr in supported]
+
+    def acquire(self, memsize, ring_addr):
+        key = (memsize, ring_addr)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+
+        logger.info('Creating VM with %#x bytes of RAM', memsize)
+        return _PooledVM(self._kvm_fd, memsize, ring_addr, self._msrs)
+
+    def release(self, pooled_vm, memsize, ring_addr):
+        with self._lock:
+            idle = self._idle.setdefault((memsize, ring_addr), [])
+            if not self._closed and len(idle) < self._max_idle:
+                idle.append(pooled_vm)
+                return
+
+        pooled_vm.close()
+
+    def close(self):
+        """
+        Destroys all the idle VMs. VMs released afterwards are destroyed as well.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+
+        for vms in idle.values():
+            for pooled_vm in vms:
+                pooled_vm.close()
+
+
+# pylint: disable=too-many-arguments
+def _check_job(memsize, max_memsize, org, payload, ranges, ring_addr, timeout):
+    """
+    Rejects jobs that would fail half-way through, before a VM is allocated for them.
+    """
+    if memsize <= 0 or memsize % PAGE_SIZE:
+        raise ValueError('Memory size must be a positive multiple of %#x' % PAGE_SIZE)
+
+    if memsize > max_memsize:
+        raise ValueError('Memory size %#x is larger than the maximum of %#x' % (memsize, max_memsize))
+
+    if org < 0 or org + len(payload) > memsize:
+        raise ValueError('Binary of %#x bytes at %#x does not fit in guest RAM' % (len(payload), org))
+
+    for r in ranges:
+        if len(r) != 2:
+            raise ValueError('Dump ranges must be (address, size) pairs')
+
+        addr, size = r
+        if addr < 0 or size < 0 or addr + size > memsize:
+            raise ValueError('Dump range %#x-%#x is outside guest RAM' % (addr, addr + size))
+
+    if ring_addr is not None and ring_addr < 0:
+        raise ValueError('Invalid hypercall ring address %#x' % ring_addr)
+
+    if timeout is not None and timeout <= 0:
+        raise ValueError('Timeout must be positive')
+
+
+def _run_with_timeout(vm, timeout):
+    """
+    Runs the VM, stopping it with VCPU.force_exit() if it runs for longer than timeout seconds.
+
+    :return: A (reason, timed_out) tuple
+    """
+    if timeout is None:
+        return vm.run(), False
+
+    timed_out = threading.Event()
+
+    def on_timeout():
+        timed_out.set()
+        vm.vcpu.force_exit()
+
+    timer = threading.Timer(timeout, on_timeout)
+    timer.start()
+    try:
+        reason = vm.run()
+    finally:
+        timer.cancel()
+        timer.join()
+
+    return reason, timed_out.is_set()
+
+
+def _regs_to_dict(regs):
+    return dict((name, getattr(regs, name)) for name, _ in regs._fields_)
+
+
+class _JobHandler(socketserver.BaseRequestHandler):
+    """
+    Runs all the jobs sent on one connection, in order.
+    """
+
+    def handle(self):
+        while True:
+            job, payload = recv_message(self.request)
+            if job is None:
+                break
+
+            try:
+                self._run_job(job, payload)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('Job failed')
+                send_message(self.request, {'type': 'error', 'message': str(e)})
+
+    def _run_job(self, job, payload):
+        if job.get('binary') is not None:
+            with open(job['binary'], 'rb') as fp:
+                payload = fp.read()
+
+        memsize = job.get('memsize', 0x20000)
+        org = job.get('org', 0)
+        ranges = [tuple(r) for r in job.get('dump', [])]
+        ring_addr = job.get('ring')
+        timeout = job.get('timeout')
+        if timeout is None:
+            timeout = self.server.default_job_timeout
+        _check_job(memsize, self.server.max_memsize, org, payload, ranges, ring_addr, timeout)
+
+        pool = self.server.pool
+        pooled_vm = pool.acquire(memsize, ring_addr)
+
+        # If anything fails, the VM may be in a weird state and is destroyed instead of being returned to the pool.
+        # This includes exits other than HLT, e.g., KVM still expects the result of an unhandled I/O instruction,
+        # and jobs that timed out, which may have been interrupted in the middle of an exit.
+        reusable = False
+        try:
+            pooled_vm.reset(job.get('rip', 0), job.get('rsp', 0xfff0))
+            vm = pooled_vm.vm
+
+            vm.ram.write(org, payload)
+            reason, timed_out = _run_with_timeout(vm, timeout)
+
+            regs = vm.vcpu.get_regs()
+            dumps = vm.ram.read_many(ranges)
+            output = bytes(pooled_vm.ring.output) if pooled_vm.ring is not None else b''
+            reusable = reason == KVMExitReason.KVM_EXIT_HLT and not timed_out
+        finally:
+            if reusable:
+                pool.release(pooled_vm, memsize, ring_addr)
+            else:
+                pooled_vm.close()
+
+        for (addr, size), data in zip(ranges, dumps):
+            send_message(self.request, {'type': 'dump', 'addr': addr, 'size': size}, data)
+
+        send_message(self.request, {
+            'type': 'done',
+            'exit_reason': reason.name,
+            'timed_out': timed_out,
+            'regs': _regs_to_dict(regs),
+        }, output)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, path, kvm_fd, default_job_timeout=None, max_memsize=DEFAULT_MAX_MEMSIZE,
+                 max_idle_vms=DEFAULT_MAX_IDLE_VMS):
+        self.pool = VMPool(kvm_fd, max_idle_vms)
+        self.max_memsize = max_memsize
+
+        # Default for jobs that do not specify a timeout, in seconds.
+        # Not to be confused with BaseServer.timeout, which applies to handle_request().
+        self.default_job_timeout = default_job_timeout
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        socketserver.UnixStreamServer.__init__(self, path, _JobHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.close()
+
+
+def main():
+    parser = ArgumentParser(description='Runs binaries sent by pykvm.client in reusable VMs')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Path of the Unix socket to listen on')
+    parser.add_argument('--log-level', default='WARNING', help='Logging level (DEBUG, INFO, WARNING, ...)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Stop jobs that run for longer than this many seconds, unless they set their own timeout')
+    parser.add_argument('--max-memsize', type=lambda x: int(x, 0), default=DEFAULT_MAX_MEMSIZE,
+                        help='Largest guest memory size that jobs can request')
+    parser.add_argument('--max-idle-vms', type=int, default=DEFAULT_MAX_IDLE_VMS,
+                        help='How many idle VMs to keep for each memory size')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+
+    # Must use open for libs2e, as it does not intercept fopen()
+    kvm_fd = os.open('/dev/kvm', os.O_RDWR)
+    logger.info('KVM API version: %d', fcntl.ioctl(kvm_fd, KVM_GET_API_VERSION))
+
+    # Jobs run VMs in their own threads, which cannot install the handler that timeouts rely on
+    install_force_exit_handler()
+
+    server = Server(args.socket, kvm_fd, args.timeout, args.max_memsize, args.max_idle_vms)
+    logger.warning('Listening on %s', args.socket)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
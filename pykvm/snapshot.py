@@ -0,0 +1,259 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+import weakref
+import zlib
+
+import numpy
+
+from pykvm.kvm import PAGE_SIZE
+from pykvm.kvm_types import KVMFpu, KVMRegs, KVMSRegs
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+logger = logging.getLogger(__name__)
+
+# Page id 0 is reserved for the zero page, which is never stored
+_ZERO_PAGE_ID = 0
+
+_COMPRESSORS = {
+    None: (lambda data: data, lambda data: data),
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+
+if lz4_frame is not None:
+    _COMPRESSORS['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+
+
+class Snapshot(object):
+    """
+    A checkpoint of the VM state. This object only holds the page manifest, the registers and the FPU state,
+    the contents of the pages live in the SnapshotStore that created the snapshot.
+    """
+
+    def __init__(self, name, page_ids, regs, sregs, fpu):
+        self.name = name
+        self.page_ids = page_ids
+        self.regs = regs
+        self.sregs = sregs
+        self.fpu = fpu
+
+    @property
+    def ram_size(self):
+        return len(self.page_ids) * PAGE_SIZE
+
+
+class _TrackedVM(object):
+    """
+    What the store last saw in the RAM of a VM. This lets the store rehash only the pages
+    that changed since the previous checkpoint or restore.
+    """
+
+    def __init__(self, data, page_ids):
+        self.data = data
+        self.page_ids = page_ids
+
+
+class SnapshotStore(object):
+    """
+    Stores many snapshots of the same guest. Guest memory is split into pages, and every unique page is
+    stored only once, keyed by its SHA-1 digest. Zero pages are not stored at all.
+
+    The store keeps one copy of the RAM of every VM it snapshotted or restored. This is what allows taking
+    and restoring snapshots to only touch the pages that changed.
+    """
+
+    def __init__(self, compression='auto'):
+        if compression == 'auto':
+            compression = 'lz4' if lz4_frame is not None else 'zlib'
+
+        if compression not in _COMPRESSORS:
+            raise ValueError('Unsupported compression %s' % compression)
+
+        self._compress, self._decompress = _COMPRESSORS[compression]
+
+        # Indexed by page id. The first entry is the zero page.
+        self._pages = [None]
+        self._digests = [None]
+        self._refcounts = numpy.zeros(1, dtype=numpy.int64)
+        self._free_ids = []
+        self._ids = {}
+
+        self._tracked = weakref.WeakKeyDictionary()
+
+    @property
+    def page_count(self):
+        """
+        :return: The number of unique non-zero pages in the store
+        """
+        return len(self._ids)
+
+    @property
+    def stored_size(self):
+        """
+        :return: How many bytes the page contents take, after compression
+        """
+        return sum(len(p) for p in self._pages if p is not None)
+
+    def _get_page_id(self, page):
+        data = page.tobytes()
+        digest = hashlib.sha1(data).digest()
+
+        page_id = self._ids.get(digest)
+        if page_id is not None:
+            return page_id
+
+        if self._free_ids:
+            page_id = self._free_ids.pop()
+        else:
+            page_id = len(self._pages)
+            self._pages.append(None)
+            self._digests.append(None)
+
+        self._pages[page_id] = self._compress(data)
+        self._digests[page_id] = digest
+        self._ids[digest] = page_id
+        return page_id
+
+    def _reference(self, page_ids):
+        counts = numpy.bincount(page_ids, minlength=len(self._pages))
+        if len(self._refcounts) < len(counts):
+            self._refcounts = numpy.concatenate(
+                [self._refcounts, numpy.zeros(len(counts) - len(self._refcounts), dtype=numpy.int64)]
+            )
+        self._refcounts[:len(counts)] += counts
+
+    def _release(self, page_ids):
+        self._refcounts[:len(self._pages)] -= numpy.bincount(page_ids, minlength=len(self._pages))
+        self._refcounts[_ZERO_PAGE_ID] = 0
+
+        for page_id in numpy.flatnonzero(self._refcounts[:len(self._pages)] == 0):
+            if page_id == _ZERO_PAGE_ID or self._pages[page_id] is None:
+                continue
+
+            del self._ids[self._digests[page_id]]
+            self._pages[page_id] = None
+            self._digests[page_id] = None
+            self._free_ids.append(page_id)
+
+    def _track(self, vm, data, page_ids):
+        old = self._tracked.get(vm)
+        self._reference(page_ids)
+        self._tracked[vm] = _TrackedVM(data, page_ids)
+        if old is not None:
+            self._release(old.page_ids)
+
+    def _scan(self, vm):
+        """
+        Brings the tracked state of the VM up to date with the current contents of its RAM.
+        :return: The tracked state
+        """
+        data = vm.ram.snapshot()
+        tracked = self._tracked.get(vm)
+
+        if tracked is None:
+            changed = numpy.arange(vm.ram.size // PAGE_SIZE)
+            page_ids = numpy.zeros(len(changed), dtype=numpy.uint32)
+        else:
+            changed = vm.ram.diff_pages(tracked.data, data)
+            page_ids = tracked.page_ids.copy()
+
+        if not changed.size and tracked is not None:
+            return tracked
+
+        is_zero = numpy.zeros(len(page_ids), dtype=bool)
+        is_zero[vm.ram.zero_pages(data)] = True
+
+        pages = data.reshape(-1, PAGE_SIZE)
+        for index in changed:
+            page_ids[index] = _ZERO_PAGE_ID if is_zero[index] else self._get_page_id(pages[index])
+
+        logger.debug('%d pages changed since the last scan', changed.size)
+        self._track(vm, data, page_ids)
+        return self._tracked[vm]
+
+    def take(self, vm, name=None):
+        """
+        Saves the RAM, register and FPU state of the VM.
+        :return: A Snapshot object that can be passed to restore()
+        """
+        tracked = self._scan(vm)
+
+        page_ids = tracked.page_ids.copy()
+        self._reference(page_ids)
+
+        return Snapshot(name, page_ids, vm.vcpu.get_regs(), vm.vcpu.get_sregs(), vm.vcpu.get_fpu())
+
+    def restore(self, vm, snapshot):
+        """
+        Brings the VM back to the state saved in the snapshot.
+        Only the pages that differ from the current contents of the guest RAM are written,
+        with one KVM_MEM_RW call per run of consecutive pages.
+
+        :return: The number of pages written
+        """
+        if snapshot.ram_size != vm.ram.size:
+            raise ValueError('Snapshot has %#x bytes of RAM, VM has %#x' % (snapshot.ram_size, vm.ram.size))
+
+        tracked = self._scan(vm)
+
+        data = tracked.data
+        pages = data.reshape(-1, PAGE_SIZE)
+        changed = numpy.flatnonzero(tracked.page_ids != snapshot.page_ids)
+
+        writes = []
+        for index in changed:
+            page_id = snapshot.page_ids[index]
+            if page_id == _ZERO_PAGE_ID:
+                pages[index] = 0
+            else:
+                pages[index] = numpy.frombuffer(self._decompress(self._pages[page_id]), dtype=numpy.uint8)
+
+            writes.append((int(index) * PAGE_SIZE, pages[index].tobytes()))
+
+        vm.ram.write_many(writes)
+        self._track(vm, data, snapshot.page_ids.copy())
+
+        vm.vcpu.set_sregs(KVMSRegs.from_buffer_copy(snapshot.sregs))
+        vm.vcpu.set_regs(KVMRegs.from_buffer_copy(snapshot.regs))
+        vm.vcpu.set_fpu(KVMFpu.from_buffer_copy(snapshot.fpu))
+
+        logger.debug('Restored snapshot %s, wrote %d pages', snapshot.name, changed.size)
+        return changed.size
+
+    def drop(self, snapshot):
+        """
+        Deletes the snapshot. Pages that are not referenced anymore are freed.
+        """
+        self._release(snapshot.page_ids)
+        snapshot.page_ids = None
+
+    def untrack(self, vm):
+        """
+        Releases the copy of the RAM kept for the given VM.
+        """
+        tracked = self._tracked.pop(vm, None)
+        if tracked is not None:
+            self._release(tracked.page_ids)
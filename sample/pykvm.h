@@ -0,0 +1,132 @@
+// Copyright (c) 2018, Cyberhaven
+//
+// Permission is hereby granted, free of charge, to any person obtaining a copy
+// of this software and associated documentation files (the "Software"), to deal
+// in the Software without restriction, including without limitation the rights
+// to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+// copies of the Software, and to permit persons to whom the Software is
+// furnished to do so, subject to the following conditions:
+//
+// The above copyright notice and this permission notice shall be included in all
+// copies or substantial portions of the Software.
+//
+// THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+// IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+// FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+// AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+// LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+// OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+// SOFTWARE.
+
+#ifndef PYKVM_H
+#define PYKVM_H
+
+#include <inttypes.h>
+
+// Guest side of the PyKVM hypercall ring (see pykvm/hypercall.py).
+//
+// Requests are queued in a ring in guest memory. Nothing happens until the guest
+// rings the doorbell, at which point PyKVM processes all queued requests at once.
+// Use pykvm_queue() + pykvm_flush() to batch requests, and pykvm_call() when the
+// result is needed right away.
+//
+// The values below must match the ones PyKVM was started with.
+
+// Raw binaries start executing at address 0, where the linker puts the first function.
+// The helpers are always inlined so that they cannot end up in front of main().
+#define PYKVM_INLINE static inline __attribute__((always_inline))
+
+#define PYKVM_RING_ADDR 0x10000
+#define PYKVM_DOORBELL_PORT 0x5000
+
+#define PYKVM_HC_WRITE 1
+
+#define PYKVM_STATUS_PENDING 0
+#define PYKVM_STATUS_OK 1
+#define PYKVM_STATUS_UNKNOWN_FUNCTION 2
+#define PYKVM_STATUS_ERROR 3
+
+struct pykvm_ring_entry {
+    uint32_t function;
+    uint32_t status;
+    uint64_t args[4];
+    uint64_t ret;
+};
+
+struct pykvm_ring {
+    // Free-running indexes, the slot is index % entries
+    uint32_t head;
+    uint32_t tail;
+    uint32_t entries;
+    uint32_t padding;
+    struct pykvm_ring_entry entry[];
+};
+
+PYKVM_INLINE volatile struct pykvm_ring *pykvm_get_ring(void)
+{
+    return (volatile struct pykvm_ring *) PYKVM_RING_ADDR;
+}
+
+// PyKVM initializes the ring when it is started with --ring, otherwise guest memory is left zeroed
+PYKVM_INLINE int pykvm_ring_enabled(void)
+{
+    return pykvm_get_ring()->entries != 0;
+}
+
+PYKVM_INLINE void pykvm_doorbell(void)
+{
+    __asm__ __volatile__("outb %%al, %%dx" : : "a"(0), "d"(PYKVM_DOORBELL_PORT) : "memory");
+}
+
+// Processes all the queued requests
+PYKVM_INLINE void pykvm_flush(void)
+{
+    volatile struct pykvm_ring *ring = pykvm_get_ring();
+    if (ring->head != ring->tail) {
+        pykvm_doorbell();
+    }
+}
+
+// Queues a request without waiting for its completion. The returned entry
+// is only valid until the ring wraps around.
+PYKVM_INLINE volatile struct pykvm_ring_entry *pykvm_queue(uint32_t function, uint64_t arg0, uint64_t arg1,
+                                                          uint64_t arg2, uint64_t arg3)
+{
+    volatile struct pykvm_ring *ring = pykvm_get_ring();
+    volatile struct pykvm_ring_entry *entry;
+
+    if (ring->head - ring->tail >= ring->entries) {
+        pykvm_doorbell();
+    }
+
+    entry = &ring->entry[ring->head % ring->entries];
+    entry->function = function;
+    entry->status = PYKVM_STATUS_PENDING;
+    entry->args[0] = arg0;
+    entry->args[1] = arg1;
+    entry->args[2] = arg2;
+    entry->args[3] = arg3;
+    entry->ret = 0;
+
+    __asm__ __volatile__("" : : : "memory");
+    ++ring->head;
+
+    return entry;
+}
+
+// Queues a request, then processes it together with all the requests queued before it
+PYKVM_INLINE uint64_t pykvm_call(uint32_t function, uint64_t arg0, uint64_t arg1, uint64_t arg2, uint64_t arg3)
+{
+    volatile struct pykvm_ring_entry *entry = pykvm_queue(function, arg0, arg1, arg2, arg3);
+    pykvm_doorbell();
+    return entry->ret;
+}
+
+// Sends size bytes at data to the host output buffer. The data must stay
+// unchanged until the next flush.
+PYKVM_INLINE void pykvm_write(const void *data, uint32_t size)
+{
+    pykvm_queue(PYKVM_HC_WRITE, (uintptr_t) data, size, 0, 0);
+}
+
+#endif
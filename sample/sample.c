@@ -20,6 +20,7 @@
 
 
 #include <inttypes.h>
+#include "pykvm.h"
 
 #ifdef USE_S2E
 #include <s2e/s2e.h>
@@ -39,9 +40,11 @@
 // - It expects to be loaded at address 0 in memory
 // - It claims a 4KB range starting at address 0x1000 as scratch data
 // - There is no standard library
-// - I/O is not possible (as PyKVM does not implement it)
+// - I/O is not possible (as PyKVM does not implement it), except for the hypercall ring
+//   when PyKVM is started with --ring (see pykvm.h)
 void main(void)
 {
+    static const char message[] = "Hello from the guest\n";
     uint8_t *data = (uint8_t*) DATA_START;
 
     // Fill the memory with a random pattern
@@ -49,6 +52,14 @@ void main(void)
         data[i] = i;
     }
 
+    // Send the message and the beginning of the pattern to PyKVM. Both requests are
+    // processed by a single VM exit when the ring is flushed.
+    if (pykvm_ring_enabled()) {
+        pykvm_write(message, sizeof(message) - 1);
+        pykvm_write(data, 0x10);
+        pykvm_flush();
+    }
+
     // Add EXTRA_CFLAGS="-DUSE_S2E -I/path/to/s2e/include" if you want to run this binary
     // in PyKVM using symbolic execution.
     #ifdef USE_S2E
@@ -37,13 +37,16 @@ setup(
     download_url='https://github.com/S2E/pykvm.git',
     install_requires=[
         'ioctl-opt',
-        'hexdump'
+        'hexdump',
+        'numpy'
     ],
     packages=find_packages(),
     include_package_data=True,
     entry_points={
         'console_scripts': [
             'pykvm = kvm:main',
+            'pykvm-server = pykvm.server:main',
+            'pykvm-client = pykvm.client:main',
         ]
     },
     classifiers=[
@@ -0,0 +1,213 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Stand-in for /dev/kvm and the S2E KVM extensions provided by libs2e.
+
+It replaces fcntl.ioctl and mmap.mmap while active, so that the PyKVM classes can be exercised
+without KVM or S2E. The guest does not execute anything: every KVM_RUN pops the next exit reason
+from a script supplied by the test.
+
+As with libs2e, when KVM_CAP_MEM_RW is enabled, guest memory is kept separately from the RAM mapping
+of the client and is only accessible through KVM_MEM_RW.
+"""
+
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import threading
+
+import pykvm.kvm
+from pykvm.kvm_types import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+
+class _FakeMmap(bytearray):
+    def close(self):
+        pass
+
+
+def _copy_to(dest, src):
+    ctypes.memmove(ctypes.addressof(dest), ctypes.addressof(src), ctypes.sizeof(src))
+
+
+class KVMStandIn(object):
+    """
+    :param capabilities: The KVMCapability values to report as supported
+    :param exits: The exit reasons returned by successive KVM_RUN calls. An entry can also be a
+                  (reason, callback) tuple, the callback is then called before KVM_RUN returns.
+    """
+
+    def __init__(self, capabilities=(), exits=()):
+        self.capabilities = set(capabilities)
+        self.exits = list(exits)
+        self.calls = []
+
+        self.regs = KVMRegs()
+        self.sregs = KVMSRegs()
+        self.fpu = KVMFpu()
+        self.xsave = KVMXsave()
+        self.xcrs = KVMXcrs()
+        self.debugregs = KVMDebugRegs()
+        self.msrs = {0x10: 0, 0x174: 0, 0x277: 0x7040600070406}
+        self.dev_state = b''
+        self.disk = {}
+        # The variable registered with KVM_SET_CLOCK_SCALE, which S2E updates
+        self.clock_scale = None
+        self.forced_exit = threading.Event()
+
+        self._run = None
+        self._saved = None
+        self._vcpu_fd = None
+
+        # Guest memory in KVM_MEM_RW mode, and the address of the RAM mapping it stands for
+        self.guest_ram = None
+        self._ram_address = None
+
+    def __enter__(self):
+        self._saved = (fcntl.ioctl, mmap.mmap)
+        fcntl.ioctl = self.ioctl
+        mmap.mmap = self.mmap
+
+        # Capabilities are cached per process, don't leak them between tests
+        pykvm.kvm._capabilities.clear()  # pylint: disable=protected-access
+        return self
+
+    def __exit__(self, *_):
+        fcntl.ioctl, mmap.mmap = self._saved
+        pykvm.kvm._capabilities.clear()  # pylint: disable=protected-access
+
+    @staticmethod
+    def _open_fd():
+        # VM.close() closes the descriptors, so they must be real ones
+        return os.open(os.devnull, os.O_RDONLY)
+
+    def mmap(self, fd, size):
+        assert fd == self._vcpu_fd
+        buf = _FakeMmap(size)
+        self._run = KVMRun.from_buffer(buf)
+        return buf
+
+    @property
+    def kvm_run(self):
+        return self._run
+
+    def count(self, request):
+        return self.calls.count(request)
+
+    # pylint: disable=too-many-return-statements,too-many-branches
+    def ioctl(self, _fd, request, arg=0, *_):
+        self.calls.append(request)
+
+        if request == KVM_CHECK_EXTENSION:
+            return int(arg in self.capabilities)
+        if request == KVM_CREATE_VM:
+            return self._open_fd()
+        if request == KVM_CREATE_VCPU:
+            self._vcpu_fd = self._open_fd()
+            return self._vcpu_fd
+        if request == KVM_GET_VCPU_MMAP_SIZE:
+            return mmap.PAGESIZE
+        if request == KVM_GET_MSR_INDEX_LIST:
+            count = arg.nmsrs
+            arg.nmsrs = len(self.msrs)
+            if count < len(self.msrs):
+                raise IOError(errno.E2BIG, os.strerror(errno.E2BIG))
+            for i, index in enumerate(sorted(self.msrs)):
+                arg.indices[i] = index
+            return 0
+        if request in (KVM_GET_MSRS, KVM_SET_MSRS):
+            # Like KVM, stop at the first unknown MSR and return the number of MSRs processed
+            for i in range(arg.nmsrs):
+                entry = arg.entries[i]
+                if entry.index not in self.msrs:
+                    return i
+                if request == KVM_GET_MSRS:
+                    entry.data = self.msrs[entry.index]
+                else:
+                    self.msrs[entry.index] = entry.data
+            return arg.nmsrs
+        if request == KVM_SET_USER_MEMORY_REGION:
+            if KVMCapability.KVM_CAP_MEM_RW in self.capabilities:
+                self.guest_ram = ctypes.create_string_buffer(arg.memory_size)
+                self._ram_address = arg.userspace_addr
+            return 0
+        if request == KVM_MEM_REGISTER_FIXED_REGION:
+            return 0
+
+        if request == KVM_GET_REGS:
+            _copy_to(arg, self.regs)
+        elif request == KVM_SET_REGS:
+            _copy_to(self.regs, arg)
+        elif request == KVM_GET_SREGS:
+            _copy_to(arg, self.sregs)
+        elif request == KVM_SET_SREGS:
+            _copy_to(self.sregs, arg)
+        elif request == KVM_GET_FPU:
+            _copy_to(arg, self.fpu)
+        elif request == KVM_SET_FPU:
+            _copy_to(self.fpu, arg)
+        elif request == KVM_GET_XSAVE:
+            _copy_to(arg, self.xsave)
+        elif request == KVM_SET_XSAVE:
+            _copy_to(self.xsave, arg)
+        elif request == KVM_GET_XCRS:
+            _copy_to(arg, self.xcrs)
+        elif request == KVM_SET_XCRS:
+            _copy_to(self.xcrs, arg)
+        elif request == KVM_GET_DEBUGREGS:
+            _copy_to(arg, self.debugregs)
+        elif request == KVM_SET_DEBUGREGS:
+            _copy_to(self.debugregs, arg)
+        elif request == KVM_RUN:
+            exit_reason = self.exits.pop(0) if self.exits else KVMExitReason.KVM_EXIT_HLT
+            if isinstance(exit_reason, tuple):
+                exit_reason, callback = exit_reason
+                callback()
+            self._run.exit_reason = exit_reason
+        elif request == KVM_MEM_RW:
+            guest = ctypes.addressof(self.guest_ram) - self._ram_address
+            if arg.is_write:
+                ctypes.memmove(arg.dest + guest, arg.source, arg.length)
+            else:
+                ctypes.memmove(arg.dest, arg.source + guest, arg.length)
+        elif request == KVM_DEV_SNAPSHOT:
+            if arg.is_write:
+                self.dev_state = ctypes.string_at(arg.buffer, arg.size)
+            else:
+                data = self.dev_state[arg.pos:arg.pos + arg.size]
+                ctypes.memmove(arg.buffer, data, len(data))
+        elif request == KVM_DISK_RW:
+            # Only sectors written by the guest are overlaid, the others are left untouched
+            for i in range(arg.count):
+                address = arg.host_address + i * 512
+                if arg.is_write:
+                    self.disk[arg.sector + i] = ctypes.string_at(address, 512)
+                elif arg.sector + i in self.disk:
+                    ctypes.memmove(address, self.disk[arg.sector + i], 512)
+        elif request == KVM_SET_CLOCK_SCALE:
+            self.clock_scale = ctypes.c_uint32.from_address(arg)
+        elif request == KVM_FORCE_EXIT:
+            self.forced_exit.set()
+        else:
+            raise IOError('Unsupported ioctl %#x' % request)
+
+        return 0
@@ -0,0 +1,130 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import ctypes
+import unittest
+
+from kvm_standin import KVMStandIn
+
+from pykvm.hypercall import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from pykvm.kvm import VM
+from pykvm.kvm_types import KVMExitIODirection, KVMExitReason, KVM_RUN
+
+HEADER_SIZE = ctypes.sizeof(HypercallRingHeader)
+ENTRY_SIZE = ctypes.sizeof(HypercallEntry)
+
+
+class HypercallRingTest(unittest.TestCase):
+    def _read_header(self, vm):
+        return HypercallRingHeader.from_buffer_copy(vm.ram.read(HYPERCALL_RING_ADDR, HEADER_SIZE))
+
+    def _read_entry(self, vm, index):
+        addr = HYPERCALL_RING_ADDR + HEADER_SIZE + (index % HYPERCALL_RING_ENTRIES) * ENTRY_SIZE
+        return HypercallEntry.from_buffer_copy(vm.ram.read(addr, ENTRY_SIZE))
+
+    def _guest(self, kvm, vm, requests, direction=KVMExitIODirection.KVM_EXIT_IO_OUT):
+        """
+        Returns a callback that does what the guest would do with pykvm_queue() and pykvm_flush().
+        """
+        def queue_and_flush():
+            header = self._read_header(vm)
+            for function, args in requests:
+                entry = HypercallEntry(function, HypercallStatus.HYPERCALL_PENDING)
+                entry.args[:len(args)] = args
+                addr = HYPERCALL_RING_ADDR + HEADER_SIZE + (header.head % header.entries) * ENTRY_SIZE
+                vm.ram.write(addr, bytes(entry))
+                header.head = (header.head + 1) & 0xffffffff
+
+            vm.ram.write(HYPERCALL_RING_ADDR, bytes(header))
+
+            io = kvm.kvm_run.exit_reasons.io
+            io.port = HYPERCALL_DOORBELL_PORT
+            io.direction = direction
+            io.size = 1
+
+        return KVMExitReason.KVM_EXIT_IO, queue_and_flush
+
+    def test_batches(self):
+        with KVMStandIn() as kvm:
+            vm = VM(0, 0x100000)
+            ring = HypercallRing(vm)
+            vm.ram.write(0x1000, b'hello ')
+            vm.ram.write(0x2000, b'world')
+
+            # Start close to the end of the ring and of the 32-bit index space
+            start = 0xfffffffe
+            vm.ram.write(HYPERCALL_RING_ADDR, bytes(HypercallRingHeader(start, start, HYPERCALL_RING_ENTRIES)))
+
+            kvm.exits = [
+                self._guest(kvm, vm, [
+                    (HypercallFunction.HYPERCALL_WRITE, [0x1000, 6]),
+                    (0x1234, [1, 2, 3, 4]),
+                    (HypercallFunction.HYPERCALL_WRITE, [0x100000, 6]),
+                    (HypercallFunction.HYPERCALL_WRITE, [0x2000, 5]),
+                ]),
+                self._guest(kvm, vm, [(HypercallFunction.HYPERCALL_WRITE, [0x1005, 1])]),
+            ]
+
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+
+            # Two batches, then hlt
+            self.assertEqual(kvm.count(KVM_RUN), 3)
+
+            header = self._read_header(vm)
+            self.assertEqual((header.head, header.tail), (3, 3))
+            self.assertEqual(ring.output, b'hello world ')
+
+            entries = [self._read_entry(vm, start + i) for i in range(5)]
+            self.assertEqual([e.status for e in entries], [
+                HypercallStatus.HYPERCALL_OK,
+                HypercallStatus.HYPERCALL_UNKNOWN_FUNCTION,
+                HypercallStatus.HYPERCALL_ERROR,
+                HypercallStatus.HYPERCALL_OK,
+                HypercallStatus.HYPERCALL_OK,
+            ])
+            self.assertEqual([e.ret for e in entries], [6, 0, 0, 5, 1])
+
+    def test_doorbell_read(self):
+        with KVMStandIn() as kvm:
+            vm = VM(0, 0x100000)
+            ring = HypercallRing(vm)
+            vm.ram.write(0x1000, b'data')
+
+            # inb from the doorbell port leaves the requests queued
+            kvm.exits = [
+                self._guest(kvm, vm, [(HypercallFunction.HYPERCALL_WRITE, [0x1000, 4])],
+                            KVMExitIODirection.KVM_EXIT_IO_IN),
+            ]
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+
+            header = self._read_header(vm)
+            self.assertEqual((header.head, header.tail), (1, 0))
+            self.assertEqual(self._read_entry(vm, 0).status, HypercallStatus.HYPERCALL_PENDING)
+            self.assertEqual(ring.output, b'')
+
+            # They are processed by the next outb
+            kvm.exits = [self._guest(kvm, vm, [])]
+            vm.run()
+            self.assertEqual(self._read_header(vm).tail, 1)
+            self.assertEqual(ring.output, b'data')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+
+import numpy
+from kvm_standin import KVMStandIn
+
+import pykvm.kvm
+from pykvm.kvm import VM
+from pykvm.kvm_types import KVMCapability, KVMExitReason
+
+
+def _find_all(data, pattern):
+    return [i for i in range(len(data) - len(pattern) + 1) if data[i:i + len(pattern)] == pattern]
+
+
+class RAMFindTest(unittest.TestCase):
+    def setUp(self):
+        # Small chunks exercise matches that straddle chunk boundaries
+        self._chunk_size = pykvm.kvm._SEARCH_CHUNK_SIZE  # pylint: disable=protected-access
+        pykvm.kvm._SEARCH_CHUNK_SIZE = 0x1000  # pylint: disable=protected-access
+
+    def tearDown(self):
+        pykvm.kvm._SEARCH_CHUNK_SIZE = self._chunk_size  # pylint: disable=protected-access
+
+    def test_find(self):
+        with KVMStandIn():
+            vm = VM(0, 0x4000)
+            data = numpy.random.RandomState(1).randint(0, 3, size=vm.ram.size).astype(numpy.uint8)
+            vm.ram.as_array()[:] = data
+            data = data.tobytes()
+
+            patterns = [b'\x00', b'\x01\x02', b'\x00\x00\x00', b'\x01\x01\x02\x00', data[0xffe:0x1003], data[-5:]]
+            results = vm.ram.find(patterns + [b'', b'x' * 0x5000])
+
+            for pattern in patterns:
+                self.assertEqual(list(results[pattern]), _find_all(data, pattern))
+            self.assertEqual(results[b''].size, 0)
+            self.assertEqual(results[b'x' * 0x5000].size, 0)
+
+    def test_find_common_prefix(self):
+        with KVMStandIn():
+            vm = VM(0, 0x4000)
+            vm.ram.write(0xffc, b'\x01')
+            vm.ram.write(0x3ff9, b'\x01')
+
+            pattern = b'\x00' * 7 + b'\x01'
+            self.assertEqual(list(vm.ram.find([pattern])[pattern]), [0xff5, 0x3ff2])
+            self.assertEqual(list(vm.ram.find([pattern], vm.ram.snapshot())[pattern]), [0xff5, 0x3ff2])
+
+
+
+class RAMMemRWTest(unittest.TestCase):
+    def test_analysis_reads_guest_memory(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]):
+            vm = VM(0, 0x10000)
+            before = vm.ram.snapshot()
+            vm.ram.write(0x3010, b'guest')
+
+            # The mapping is stale, only KVM_MEM_RW sees the write
+            self.assertFalse(vm.ram.as_array().any())
+
+            self.assertEqual(list(vm.ram.diff_pages(before)), [3])
+            self.assertNotIn(3, vm.ram.zero_pages())
+            self.assertEqual(list(vm.ram.find([b'guest'])[b'guest']), [0x3010])
+            self.assertTrue((vm.ram.page_hashes() == vm.ram.page_hashes(vm.ram.snapshot())).all())
+            self.assertFalse((vm.ram.page_hashes() == vm.ram.page_hashes(before)).all())
+
+
+
+class RAMBatchTest(unittest.TestCase):
+    def test_read_many_coalesces(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]):
+            vm = VM(0, 0x100000)
+            vm.ram.write(0x1000, bytes(bytearray(range(256))) * 0x100)
+
+            # 500 small reads, close to each other, in random order
+            ranges = [(0x1000 + i * 0x40, 8) for i in range(500)]
+            numpy.random.RandomState(0).shuffle(ranges)
+
+            count = vm.ram.mem_rw_count
+            data = vm.ram.read_many(ranges)
+            self.assertEqual(vm.ram.mem_rw_count - count, 1)
+            self.assertEqual(data, [vm.ram.read(addr, size) for addr, size in ranges])
+
+            # Ranges that are far apart are read separately
+            count = vm.ram.mem_rw_count
+            vm.ram.read_many([(0, 4), (0x80000, 4), (0xffffc, 4)])
+            self.assertEqual(vm.ram.mem_rw_count - count, 3)
+
+    def test_write_many(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]):
+            vm = VM(0, 0x10000)
+
+            count = vm.ram.mem_rw_count
+            vm.ram.write_many([(0x100, b'aaaa'), (0x102, b'bbbb'), (0x101, b'c'), (0x2000, b'far')])
+            self.assertEqual(vm.ram.mem_rw_count - count, 2)
+
+            # Later writes win
+            self.assertEqual(vm.ram.read(0x100, 6), b'acbbbb')
+            self.assertEqual(vm.ram.read(0x2000, 3), b'far')
+
+    def test_cache(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]) as kvm:
+            vm = VM(0, 0x10000)
+            vm.ram.write(0x1ffe, b'abcd')
+            vm.ram.enable_cache()
+
+            # Two consecutive pages are fetched at once, then reads are served from the cache
+            count = vm.ram.mem_rw_count
+            self.assertEqual(vm.ram.read(0x1ffe, 4), b'abcd')
+            self.assertEqual(vm.ram.read_many([(0x1000, 2), (0x2002, 2)]), [b'\0\0', b'\0\0'])
+            self.assertEqual(vm.ram.mem_rw_count - count, 1)
+
+            # Writes update the cached pages
+            vm.ram.write(0x1fff, b'XY')
+            count = vm.ram.mem_rw_count
+            self.assertEqual(vm.ram.read(0x1ffe, 4), b'aXYd')
+            self.assertEqual(vm.ram.mem_rw_count, count)
+
+            # The guest changes memory while it runs, so the cache is dropped before KVM_RUN
+            def guest_write():
+                kvm.guest_ram[0x1ffe] = b'g'
+
+            kvm.exits = [(KVMExitReason.KVM_EXIT_HLT, guest_write)]
+            vm.run()
+            self.assertEqual(vm.ram.read(0x1ffe, 4), b'gXYd')
+            self.assertEqual(vm.ram.mem_rw_count - count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
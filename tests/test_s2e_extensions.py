@@ -0,0 +1,143 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+
+from kvm_standin import KVMStandIn
+
+from pykvm.kvm import VM
+from pykvm.kvm_types import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+S2E_CAPABILITIES = [
+    KVMCapability.KVM_CAP_MEM_RW,
+    KVMCapability.KVM_CAP_FORCE_EXIT,
+    KVMCapability.KVM_CAP_DISK_RW,
+    KVMCapability.KVM_CAP_DEV_SNAPSHOT,
+    KVMCapability.KVM_CAP_CPU_CLOCK_SCALE,
+]
+
+
+class _Device(object):
+    def __init__(self, state):
+        self.state = state
+
+    def save(self):
+        return self.state
+
+    def restore(self, data):
+        self.state = data
+
+
+class S2EExtensionsTest(unittest.TestCase):
+    def test_device_state_round_trip(self):
+        with KVMStandIn(S2E_CAPABILITIES) as kvm:
+            vm = VM(0, 0x10000)
+            devices = [_Device(b'first'), _Device(b''), _Device(b'third')]
+            for d in devices:
+                vm.register_device(d.save, d.restore)
+
+            kvm.exits = [KVMExitReason.KVM_EXIT_SAVE_DEV_STATE]
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+
+            for d in devices:
+                d.state = b'changed'
+
+            kvm.exits = [KVMExitReason.KVM_EXIT_RESTORE_DEV_STATE]
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+            self.assertEqual([d.state for d in devices], [b'first', b'', b'third'])
+
+    def test_device_state_mismatch(self):
+        with KVMStandIn(S2E_CAPABILITIES) as kvm:
+            vm = VM(0, 0x10000)
+            device = _Device(b'state')
+            vm.register_device(device.save, device.restore)
+
+            kvm.exits = [KVMExitReason.KVM_EXIT_SAVE_DEV_STATE]
+            vm.run()
+
+            vm.register_device(device.save, device.restore)
+            kvm.exits = [KVMExitReason.KVM_EXIT_RESTORE_DEV_STATE]
+            self.assertRaises(RuntimeError, vm.run)
+
+    def test_clone_process(self):
+        with KVMStandIn(S2E_CAPABILITIES) as kvm:
+            vm = VM(0, 0x10000)
+            events = []
+            vm.register_clone_handler(lambda: events.append('clone'))
+
+            kvm.exits = [
+                KVMExitReason.KVM_EXIT_CLONE_PROCESS,
+                (KVMExitReason.KVM_EXIT_HLT, lambda: events.append('resumed')),
+            ]
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+            self.assertEqual(events, ['clone', 'resumed'])
+
+    def test_disk_rw(self):
+        with KVMStandIn(S2E_CAPABILITIES):
+            vm = VM(0, 0x10000)
+            self.assertEqual(vm.disk_write(4, b'a' * 512 + b'b' * 512), 2)
+
+            # Sector 3 comes from the image, 4 and 5 from the writes of the current path
+            data = vm.disk_read(3, b'x' * 512 * 3)
+            self.assertEqual(data, b'x' * 512 + b'a' * 512 + b'b' * 512)
+
+            self.assertRaises(ValueError, vm.disk_write, 0, b'short')
+
+    def test_clock_scale_and_force_exit(self):
+        with KVMStandIn(S2E_CAPABILITIES) as kvm:
+            vm = VM(0, 0x10000)
+            vm.register_clock_scale()
+            self.assertEqual(kvm.count(KVM_SET_CLOCK_SCALE), 1)
+            self.assertEqual(vm.clock_scale, 1)
+
+            # The engine slows down the clock
+            kvm.clock_scale.value = 10
+            self.assertEqual(vm.clock_scale, 10)
+
+            vm.vcpu.force_exit()
+            self.assertEqual(kvm.count(KVM_FORCE_EXIT), 1)
+
+            # The exit is reported even if KVM_RUN did not enter the guest
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_INTR)
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+
+    def test_ioctl_numbers(self):
+        # The stand-in uses the same constants, so check them against the values in S2E's kvm.h
+        self.assertEqual(KVM_MEM_RW, 0x4020aef3)
+        self.assertEqual(KVM_FORCE_EXIT, 0xaef4)
+        self.assertEqual(KVM_MEM_REGISTER_FIXED_REGION, 0x4020aef5)
+        self.assertEqual(KVM_DISK_RW, 0xc018aef6)
+        self.assertEqual(KVM_SET_CLOCK_SCALE, 0xc008aef7)
+        self.assertEqual(KVM_DEV_SNAPSHOT, 0xc018aef8)
+
+    def test_capabilities(self):
+        with KVMStandIn(S2E_CAPABILITIES):
+            vm = VM(0, 0x10000)
+            self.assertTrue(vm.has_mem_rw)
+            self.assertTrue(vm.has_dev_snapshot)
+
+        with KVMStandIn():
+            vm = VM(0, 0x10000)
+            self.assertFalse(vm.has_mem_rw)
+            self.assertFalse(vm.has_dev_snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from kvm_standin import KVMStandIn
+
+from pykvm.client import Client
+from pykvm.kvm import FORCE_EXIT_SIGNAL
+from pykvm.kvm_types import KVMCapability, KVMExitReason, KVM_CREATE_VM
+from pykvm.server import Server, VMPool, DEFAULT_MAX_MEMSIZE
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self._handler = signal.signal(FORCE_EXIT_SIGNAL, lambda *_: None)
+
+        self._standin = KVMStandIn()
+        self.kvm = self._standin.__enter__()
+
+        self._dir = tempfile.mkdtemp()
+        path = os.path.join(self._dir, 'pykvm.sock')
+        self.server = Server(path, 0)
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.start()
+        self.client = Client(path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        shutil.rmtree(self._dir)
+        self._standin.__exit__(None, None, None)
+        signal.signal(FORCE_EXIT_SIGNAL, self._handler)
+
+    def test_vm_reuse(self):
+        result, dumps = self.client.run(data=b'\xf4', dump=[(0, 4)])
+        self.assertEqual(result['exit_reason'], 'KVM_EXIT_HLT')
+        self.assertEqual(dumps, [(0, b'\xf4\0\0\0')])
+
+        self.client.run(data=b'\xf4')
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 1)
+
+    def test_vm_discarded_after_io_exit(self):
+        self.kvm.exits = [KVMExitReason.KVM_EXIT_IO]
+        result, _ = self.client.run(data=b'\xe4\x60')
+        self.assertEqual(result['exit_reason'], 'KVM_EXIT_IO')
+
+        self.client.run(data=b'\xf4')
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 2)
+
+    def test_fpu_reset(self):
+        def clobber_fpu():
+            self.kvm.fpu.mxcsr = 0xffff
+            self.kvm.fpu.xmm[0][0] = 0x42
+
+        initial = bytes(self.kvm.fpu)
+        self.kvm.exits = [(KVMExitReason.KVM_EXIT_HLT, clobber_fpu)]
+        self.client.run(data=b'\xf4')
+        self.assertNotEqual(bytes(self.kvm.fpu), initial)
+
+        self.client.run(data=b'\xf4')
+        self.assertEqual(bytes(self.kvm.fpu), initial)
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 1)
+
+    def test_cpu_state_reset(self):
+        self.kvm.capabilities.update([
+            KVMCapability.KVM_CAP_XSAVE, KVMCapability.KVM_CAP_XCRS, KVMCapability.KVM_CAP_DEBUGREGS,
+        ])
+
+        def clobber_cpu():
+            self.kvm.xsave.region[160] = 0x42
+            self.kvm.xcrs.xcrs[0].value = 7
+            self.kvm.debugregs.dr7 = 0x400
+            self.kvm.msrs[0x174] = 0x10
+            self.kvm.msrs[0x277] = 0
+
+        initial = [bytes(self.kvm.xsave), bytes(self.kvm.xcrs), bytes(self.kvm.debugregs), dict(self.kvm.msrs)]
+        self.kvm.exits = [(KVMExitReason.KVM_EXIT_HLT, clobber_cpu)]
+        self.client.run(data=b'\xf4')
+
+        self.client.run(data=b'\xf4')
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 1)
+        self.assertEqual(
+            [bytes(self.kvm.xsave), bytes(self.kvm.xcrs), bytes(self.kvm.debugregs), self.kvm.msrs], initial)
+
+    def _check_timeout(self, wait_for_exit):
+        # The guest does not halt until it is forced out
+        self.kvm.exits = [(KVMExitReason.KVM_EXIT_INTR, wait_for_exit)]
+        result, _ = self.client.run(data=b'\xeb\xfe', timeout=0.1)
+        self.assertEqual(result['exit_reason'], 'KVM_EXIT_INTR')
+        self.assertTrue(result['timed_out'])
+
+        result, _ = self.client.run(data=b'\xf4', timeout=0.1)
+        self.assertEqual(result['exit_reason'], 'KVM_EXIT_HLT')
+        self.assertFalse(result['timed_out'])
+
+        # The VM that timed out was discarded
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 2)
+
+    def test_timeout_force_exit(self):
+        self.kvm.capabilities.add(KVMCapability.KVM_CAP_FORCE_EXIT)
+        self._check_timeout(lambda: self.assertTrue(self.kvm.forced_exit.wait(5)))
+
+    def test_timeout_immediate_exit(self):
+        def wait_for_exit():
+            deadline = time.time() + 5
+            while not self.kvm.kvm_run.immediate_exit and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(self.kvm.kvm_run.immediate_exit)
+
+        self._check_timeout(wait_for_exit)
+
+    def test_default_job_timeout(self):
+        self.server.default_job_timeout = 0.1
+        self.kvm.exits = [(KVMExitReason.KVM_EXIT_INTR, lambda: self.assertTrue(self.kvm.forced_exit.wait(5)))]
+        self.kvm.capabilities.add(KVMCapability.KVM_CAP_FORCE_EXIT)
+
+        result, _ = self.client.run(data=b'\xeb\xfe')
+        self.assertTrue(result['timed_out'])
+
+        # The job timeout does not leak into the socketserver polling timeout
+        self.assertIsNone(self.server.timeout)
+
+    def test_invalid_jobs(self):
+        jobs = [
+            {'memsize': 0x1234},
+            {'data': b'\x90' * 0x21000},
+            {'org': 0x1ffff, 'data': b'\x90\x90'},
+            {'dump': [(0x1ff00, 0x200)]},
+            {'dump': [(-1, 0x10)]},
+            {'timeout': 0},
+            {'memsize': DEFAULT_MAX_MEMSIZE + 0x1000},
+        ]
+        for job in jobs:
+            self.assertRaises(RuntimeError, self.client.run, **job)
+
+        # The jobs were rejected before getting a VM
+        self.assertEqual(self.kvm.count(KVM_CREATE_VM), 0)
+
+        result, _ = self.client.run(data=b'\xf4')
+        self.assertEqual(result['exit_reason'], 'KVM_EXIT_HLT')
+
+
+
+class VMPoolTest(unittest.TestCase):
+    def test_limits(self):
+        with KVMStandIn():
+            pool = VMPool(0, max_idle=2)
+            vms = [pool.acquire(0x10000, None) for _ in range(3)]
+            for pooled_vm in vms:
+                pool.release(pooled_vm, 0x10000, None)
+
+            # Only two VMs are kept, the third one was destroyed
+            self.assertEqual([pooled_vm.vm.ram.obj is None for pooled_vm in vms], [False, False, True])
+
+            reused = [pool.acquire(0x10000, None) for _ in range(2)]
+            self.assertEqual(sorted(map(id, reused)), sorted(map(id, vms[:2])))
+            pool.release(reused[0], 0x10000, None)
+
+            pool.close()
+            self.assertIsNone(reused[0].vm.ram.obj)
+
+            # VMs that were in use when the pool was closed are destroyed when they are released
+            pool.release(reused[1], 0x10000, None)
+            self.assertIsNone(reused[1].vm.ram.obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+
+from kvm_standin import KVMStandIn
+
+from pykvm.kvm import VM, PAGE_SIZE
+from pykvm.kvm_types import KVMCapability, KVM_MEM_RW
+from pykvm.snapshot import SnapshotStore
+
+
+class SnapshotStoreTest(unittest.TestCase):
+    def _round_trip(self, capabilities):
+        with KVMStandIn(capabilities) as kvm:
+            vm = VM(0, 0x10000)
+            vm.ram.write(PAGE_SIZE, b'first')
+            vm.ram.write(5 * PAGE_SIZE, b'second')
+            kvm.regs.rax = 1
+
+            store = SnapshotStore()
+            snapshot = store.take(vm)
+
+            vm.ram.write(PAGE_SIZE, b'changed')
+            vm.ram.write(7 * PAGE_SIZE, b'new')
+            kvm.regs.rax = 2
+
+            store.restore(vm, snapshot)
+            self.assertEqual(vm.ram.read(PAGE_SIZE, 7), b'first\0\0')
+            self.assertEqual(vm.ram.read(5 * PAGE_SIZE, 6), b'second')
+            self.assertEqual(vm.ram.read(7 * PAGE_SIZE, 3), b'\0\0\0')
+            self.assertEqual(kvm.regs.rax, 1)
+
+            # Restoring again starts from the pages written by the previous restore
+            vm.ram.write(5 * PAGE_SIZE, b'again')
+            store.restore(vm, snapshot)
+            self.assertEqual(vm.ram.read(5 * PAGE_SIZE, 6), b'second')
+
+    def test_round_trip(self):
+        self._round_trip([])
+
+    def test_round_trip_mem_rw(self):
+        self._round_trip([KVMCapability.KVM_CAP_MEM_RW])
+
+    def test_restore_batches_writes(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]) as kvm:
+            vm = VM(0, 0x10000)
+            store = SnapshotStore()
+            snapshot = store.take(vm)
+
+            # Cost of a restore that writes nothing
+            count = kvm.count(KVM_MEM_RW)
+            self.assertEqual(store.restore(vm, snapshot), 0)
+            scan = kvm.count(KVM_MEM_RW) - count
+
+            for index in (2, 3, 4, 9):
+                vm.ram.write(index * PAGE_SIZE, b'changed')
+
+            # One write for pages 2-4, one for page 9
+            count = kvm.count(KVM_MEM_RW)
+            self.assertEqual(store.restore(vm, snapshot), 4)
+            self.assertEqual(kvm.count(KVM_MEM_RW) - count, scan + 2)
+            self.assertEqual(vm.ram.snapshot().any(), False)
+
+    def test_fpu(self):
+        with KVMStandIn() as kvm:
+            vm = VM(0, 0x10000)
+            kvm.fpu.mxcsr = 0x1f80
+            kvm.fpu.xmm[1][0] = 0x42
+
+            store = SnapshotStore()
+            snapshot = store.take(vm)
+            initial = bytes(kvm.fpu)
+
+            kvm.fpu.mxcsr = 0x1f00
+            kvm.fpu.xmm[1][0] = 0
+
+            store.restore(vm, snapshot)
+            self.assertEqual(bytes(kvm.fpu), initial)
+
+    def test_mem_rw_snapshot_is_writable(self):
+        with KVMStandIn([KVMCapability.KVM_CAP_MEM_RW]):
+            vm = VM(0, 0x10000)
+            vm.ram.write(0x10, b'abc')
+            data = vm.ram.snapshot()
+            self.assertTrue(data.flags.writeable)
+            self.assertEqual(data[0x10:0x13].tobytes(), b'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
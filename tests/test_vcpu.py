@@ -0,0 +1,72 @@
+# Copyright (c) 2018, Cyberhaven
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import signal
+import threading
+import time
+import unittest
+
+from kvm_standin import KVMStandIn
+
+from pykvm.kvm import VM, FORCE_EXIT_SIGNAL
+from pykvm.kvm_types import KVMExitReason
+
+
+class ForceExitTest(unittest.TestCase):
+    def setUp(self):
+        self._handler = signal.signal(FORCE_EXIT_SIGNAL, signal.SIG_DFL)
+
+    def tearDown(self):
+        signal.signal(FORCE_EXIT_SIGNAL, self._handler)
+
+    def _run_until_forced(self, kvm, vm):
+        def wait_for_exit():
+            deadline = time.time() + 5
+            while not kvm.kvm_run.immediate_exit and time.time() < deadline:
+                time.sleep(0.01)
+
+        # The guest does not halt until it is forced out
+        kvm.exits = [(KVMExitReason.KVM_EXIT_INTR, wait_for_exit)]
+        timer = threading.Timer(0.05, vm.vcpu.force_exit)
+        timer.start()
+        try:
+            return vm.run()
+        finally:
+            timer.join()
+
+    def test_handler_installed(self):
+        with KVMStandIn() as kvm:
+            vm = VM(0, 0x10000)
+            self.assertNotEqual(signal.getsignal(FORCE_EXIT_SIGNAL), signal.SIG_DFL)
+            self.assertEqual(self._run_until_forced(kvm, vm), KVMExitReason.KVM_EXIT_INTR)
+            self.assertEqual(vm.run(), KVMExitReason.KVM_EXIT_HLT)
+
+    def test_no_handler(self):
+        with KVMStandIn() as kvm:
+            vm = VM(0, 0x10000)
+
+            # run() installs the handler, remove it right before KVM_RUN. Sending the signal would then
+            # kill the test process.
+            vm.vcpu.register_pre_run_handler(lambda: signal.signal(FORCE_EXIT_SIGNAL, signal.SIG_DFL))
+            self.assertEqual(self._run_until_forced(kvm, vm), KVMExitReason.KVM_EXIT_INTR)
+
+
+if __name__ == '__main__':
+    unittest.main()